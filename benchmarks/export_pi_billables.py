@@ -0,0 +1,90 @@
+"""Times `export_pi_billables` against filtering the invoice once per PI
+
+Run from the repository root:
+
+    python -m benchmarks.export_pi_billables --pis 10000 --rows 50000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import pandas
+
+from process_report import process_report
+
+
+INSTITUTIONS = ["Boston University", "Harvard University", "MIT"]
+
+
+def make_invoice(pis, rows, seed=0):
+    rng = random.Random(seed)
+    pi_names = [f"pi{i}@example.edu" for i in range(pis)]
+    pi_column = pi_names + [rng.choice(pi_names) for _ in range(rows - pis)]
+    rng.shuffle(pi_column)
+    return process_report.apply_invoice_dtypes(
+        pandas.DataFrame(
+            {
+                process_report.INVOICE_DATE_FIELD: ["2024-03"] * rows,
+                process_report.PROJECT_FIELD: [f"project-{i}" for i in range(rows)],
+                process_report.PI_FIELD: pi_column,
+                process_report.INSTITUTION_FIELD: [
+                    INSTITUTIONS[hash(pi) % len(INSTITUTIONS)] for pi in pi_column
+                ],
+                process_report.COST_FIELD: [
+                    f"{rng.randrange(1, 100000) / 100:.2f}" for _ in range(rows)
+                ],
+            }
+        )
+    )
+
+
+def export_per_pi_filter(dataframe, output_folder, invoice_month):
+    """The previous implementation, which re-filters the invoice for every PI"""
+    for pi in dataframe[process_report.PI_FIELD].unique():
+        pi_projects = dataframe[dataframe[process_report.PI_FIELD] == pi]
+        pi_instituition = pi_projects[process_report.INSTITUTION_FIELD].iat[0]
+        pi_projects.to_csv(
+            output_folder + f"/{pi_instituition}_{pi}_{invoice_month}.csv"
+        )
+
+
+def time_export(export, dataframe, repeat, **kwargs):
+    """Returns the best time of `repeat` runs, and the number of files written"""
+    times = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as output_folder:
+            start = time.perf_counter()
+            export(dataframe, output_folder, "2024-03", **kwargs)
+            times.append(time.perf_counter() - start)
+            file_count = len(os.listdir(output_folder))
+    return min(times), file_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pis", type=int, default=10000)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    dataframe = make_invoice(args.pis, args.rows)
+
+    print(f"{'writer':>22} {'files':>6} {'time (s)':>9}")
+    baseline, file_count = time_export(export_per_pi_filter, dataframe, repeat=1)
+    print(f"{'filter per PI':>22} {file_count:>6} {baseline:>9.3f}")
+    for jobs in sorted({1, args.jobs}):
+        elapsed, file_count = time_export(
+            process_report.export_pi_billables, dataframe, args.repeat, jobs=jobs
+        )
+        print(
+            f"{f'partitioned, {jobs} jobs':>22} {file_count:>6} {elapsed:>9.3f}"
+            f" ({baseline / elapsed:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""A local directory standing in for the invoice bucket, so that the S3 fetches
+and uploads of `process_report` can be run and timed offline
+
+    with local_s3.use_local_bucket(directory) as bucket:
+        bucket.put_file("Invoices/2024-03/Service Invoices/a.csv", "a.csv")
+        process_report.main()
+
+Each object is stored as a file named by its key under the directory. Only the
+parts of the boto3 `Bucket` API used by `process_report` are provided.
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+import types
+from unittest import mock
+
+import botocore.exceptions
+
+from process_report import process_report
+
+
+class LocalBucket:
+    def __init__(self, root, name="invoices"):
+        self.root = root
+        self.name = name
+        self.objects = types.SimpleNamespace(
+            all=self.list_objects, filter=self.list_objects
+        )
+        self.meta = types.SimpleNamespace(
+            client=types.SimpleNamespace(
+                head_object=self.head_object,
+                get_object=self.get_object,
+                copy_object=self.copy_object,
+            )
+        )
+
+    def get_path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def list_objects(self, Prefix=""):
+        keys = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                path = os.path.relpath(os.path.join(directory, file), self.root)
+                keys.append(path.replace(os.sep, "/"))
+        return [
+            types.SimpleNamespace(key=key)
+            for key in sorted(keys)
+            if key.startswith(Prefix)
+        ]
+
+    def head_object(self, Bucket, Key):
+        path = self.get_path(Key)
+        if not os.path.exists(path):
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+            )
+        with open(path, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        return {"ETag": f'"{etag}"', "ContentLength": os.path.getsize(path)}
+
+    def Object(self, key):
+        return types.SimpleNamespace(
+            get=lambda: {"Body": open(self.get_path(key), "rb")}
+        )
+
+    def get_object(self, Bucket, Key, IfMatch=None):
+        if IfMatch is not None and self.head_object(Bucket, Key)["ETag"] != IfMatch:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "412", "Message": "Precondition Failed"}},
+                "GetObject",
+            )
+        return {"Body": open(self.get_path(Key), "rb")}
+
+    def download_file(self, key, local_name):
+        shutil.copyfile(self.get_path(key), local_name)
+
+    def put_file(self, key, local_file):
+        self.upload_file(local_file, key)
+
+    def upload_file(self, local_file, key):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_file, path)
+
+    def upload_fileobj(self, fileobj, key):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.upload_file(self.get_path(CopySource["Key"]), Key)
+
+
+@contextlib.contextmanager
+def use_local_bucket(root):
+    """Makes `process_report` use a `LocalBucket` of `root` as its invoice bucket"""
+    bucket = LocalBucket(root)
+    with mock.patch.object(process_report, "get_invoice_bucket", return_value=bucket):
+        yield bucket
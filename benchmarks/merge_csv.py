@@ -0,0 +1,78 @@
+"""Times `merge_csv` with increasing numbers of invoice files and worker threads
+
+Run from the repository root:
+
+    python -m benchmarks.merge_csv --rows 200000 --max-files 8
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import pandas
+
+from process_report import process_report
+
+
+SU_TYPES = ["OpenShift CPU", "OpenStack CPU", "OpenStack Storage", "OpenShift GPUA100"]
+
+
+def write_invoice(path, rows, seed):
+    rng = random.Random(seed)
+    pandas.DataFrame(
+        {
+            process_report.INVOICE_DATE_FIELD: ["2024-03"] * rows,
+            process_report.PROJECT_FIELD: [
+                f"project-{rng.randrange(rows // 10 + 1)}" for _ in range(rows)
+            ],
+            process_report.PI_FIELD: [
+                f"pi{rng.randrange(rows // 50 + 1)}@bu.edu" for _ in range(rows)
+            ],
+            process_report.INSTITUTION_FIELD: [""] * rows,
+            process_report.SU_HOURS_FIELD: [
+                rng.randrange(1, 1000) for _ in range(rows)
+            ],
+            process_report.SU_TYPE_FIELD: [rng.choice(SU_TYPES) for _ in range(rows)],
+            process_report.COST_FIELD: [
+                f"{rng.randrange(1, 100000) / 100:.2f}" for _ in range(rows)
+            ],
+        }
+    ).to_csv(path, index=False)
+
+
+def time_merge(files, jobs):
+    # Both runs go through the pyarrow reader so only the threading differs
+    start = time.perf_counter()
+    process_report.merge_csv(files, batch_size=1 << 20, jobs=jobs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000, help="Rows per file")
+    parser.add_argument("--max-files", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        all_files = []
+        for i in range(args.max_files):
+            path = os.path.join(tmpdir, f"invoice{i}.csv")
+            write_invoice(path, args.rows, seed=i)
+            all_files.append(path)
+
+        print(f"{'files':>5} {'serial (s)':>11} {'parallel (s)':>13} {'speedup':>8}")
+        file_count = 1
+        while file_count <= args.max_files:
+            files = all_files[:file_count]
+            serial = time_merge(files, jobs=1)
+            parallel = time_merge(files, jobs=file_count)
+            print(
+                f"{file_count:>5} {serial:>11.3f} {parallel:>13.3f} {serial / parallel:>7.2f}x"
+            )
+            file_count *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Times each processing stage and the whole of `process_report.main` on
+synthetic invoices of increasing size, offline
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline --tiers 1 10 100
+
+Each tier scales the rows, PIs and projects of the base invoice by its factor.
+The invoices are fetched from and uploaded to a local directory standing in
+for S3. The results are stored as `.benchmarks/<revision>.json`, or under `--name`,
+and `--compare` prints how they changed from those of another revision.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from benchmarks import local_s3
+from benchmarks import synthetic
+from process_report import process_report
+
+
+INVOICE_MONTH = "2024-03"
+
+
+def get_revision():
+    """Returns the git revision of the repository, with `+` if it has changes"""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+        changes = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("+" if changes else "")
+
+
+def run_tier(work_dir, scale, args):
+    """Generates the invoices of a tier in `work_dir`, processes them with
+    `process_report.main`, and returns the time of each stage"""
+    data_dir = os.path.join(work_dir, "data")
+    start = time.perf_counter()
+    paths = synthetic.generate_invoices(
+        data_dir,
+        rows=args.rows * scale,
+        pis=args.pis * scale,
+        projects=args.projects * scale,
+        invoice_month=INVOICE_MONTH,
+        seed=args.seed,
+    )
+    print(f"Generated {args.rows * scale} rows in {time.perf_counter() - start:.1f}s")
+
+    run_dir = os.path.join(work_dir, "run")
+    os.makedirs(run_dir)
+    report_file = os.path.join(work_dir, "report.json")
+    argv = [
+        "process_report.py",
+        "--fetch-from-s3",
+        "--upload-to-s3",
+        f"--invoice-month={INVOICE_MONTH}",
+        f"--pi-file={paths['pi_file']}",
+        f"--projects-file={paths['projects_file']}",
+        f"--timed-projects-file={paths['timed_projects_file']}",
+        "--BU-subsidy-amount=100",
+        f"--jobs={args.jobs}",
+        f"--stage-report={report_file}",
+        *args.main_args,
+    ]
+    cwd = os.getcwd()
+    with local_s3.use_local_bucket(os.path.join(work_dir, "s3")) as bucket:
+        for csv_file in paths["csv_files"]:
+            bucket.put_file(
+                f"Invoices/{INVOICE_MONTH}/Service Invoices/{os.path.basename(csv_file)}",
+                csv_file,
+            )
+        bucket.put_file(process_report.PI_S3_FILEPATH, paths["old_pi_file"])
+        bucket.put_file(process_report.ALIAS_S3_FILEPATH, paths["alias_file"])
+
+        os.chdir(run_dir)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                devnull
+            ), mock.patch("sys.argv", argv):
+                process_report.main()
+        finally:
+            os.chdir(cwd)
+
+    with open(report_file) as f:
+        report = json.load(f)
+    return {
+        "rows": args.rows * scale,
+        "wall_time": report["wall_time"],
+        "stages": {
+            stage["stage"]: {
+                "wall_time": stage["wall_time"],
+                "cpu_time": stage["cpu_time"],
+                "max_rss": stage["max_rss"],
+            }
+            for stage in report["stages"]
+        },
+    }
+
+
+def print_results(results, baseline=None):
+    """Prints the wall time of each stage in each tier, and its ratio to the
+    time in `baseline` if given"""
+    tiers = list(results["tiers"])
+    stages = []
+    for tier in tiers:
+        for stage in results["tiers"][tier]["stages"]:
+            if stage not in stages:
+                stages.append(stage)
+
+    def format_time(tier, stage):
+        tier_results = results["tiers"][tier]
+        if stage is None:
+            wall_time = tier_results["wall_time"]
+        elif stage in tier_results["stages"]:
+            wall_time = tier_results["stages"][stage]["wall_time"]
+        else:
+            return ""
+        text = f"{wall_time:.3f}"
+        baseline_tier = (baseline or {}).get("tiers", {}).get(tier)
+        if baseline_tier is not None:
+            if stage is None:
+                baseline_time = baseline_tier["wall_time"]
+            else:
+                baseline_time = baseline_tier["stages"].get(stage, {}).get("wall_time")
+            if baseline_time:
+                text += f" ({wall_time / baseline_time:.2f}x)"
+        return text
+
+    width = 18 if baseline else 10
+    print(f"{'stage':<24}" + "".join(f"{f'{tier} (s)':>{width}}" for tier in tiers))
+    print(
+        f"{'rows':<24}"
+        + "".join(f"{results['tiers'][tier]['rows']:>{width}}" for tier in tiers)
+    )
+    for stage in stages + [None]:
+        print(
+            f"{stage or 'total':<24}"
+            + "".join(f"{format_time(tier, stage):>{width}}" for tier in tiers)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tiers",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100],
+        help="Factors the base invoice is scaled by",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=10000, help="Rows of the base invoice"
+    )
+    parser.add_argument("--pis", type=int, default=500, help="PIs of the base invoice")
+    parser.add_argument(
+        "--projects", type=int, default=2000, help="Projects of the base invoice"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs of process_report")
+    parser.add_argument(
+        "--results-dir",
+        default=".benchmarks",
+        help="Directory the results are stored in, by revision",
+    )
+    parser.add_argument(
+        "--name",
+        help="Name the results are stored under (default: the revision)",
+    )
+    parser.add_argument(
+        "--compare", help="Results file, or name, to compare the results with"
+    )
+    parser.add_argument(
+        "main_args",
+        nargs="*",
+        help="Other arguments of process_report, after --",
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        compare_file = args.compare
+        if not os.path.exists(compare_file):
+            compare_file = os.path.join(args.results_dir, f"{args.compare}.json")
+        with open(compare_file) as f:
+            baseline = json.load(f)
+
+    results = {
+        "revision": get_revision(),
+        "python": sys.version.split()[0],
+        "args": args.main_args,
+        "tiers": {},
+    }
+    for scale in args.tiers:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results["tiers"][f"{scale}x"] = run_tier(work_dir, scale, args)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_file = os.path.join(
+        args.results_dir, f"{args.name or results['revision']}.json"
+    )
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print(f"Results stored in {results_file}")
+
+    if baseline is not None:
+        print(f"Compared with {baseline['revision']} {' '.join(baseline['args'])}")
+    print_results(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Generates seeded synthetic service invoices and the files processed with them
+
+Run from the repository root:
+
+    python -m benchmarks.synthetic invoices/ --rows 100000 --pis 2000
+
+writes the service invoices, a matching PI ledger, and alias, non-billable
+PI, non-billable project and timed project files to `invoices/`.
+"""
+
+import argparse
+import os
+
+import numpy
+import pandas
+
+from process_report import process_report
+
+
+# The service invoices, and the SU types and hourly rates each of them bills
+SERVICES = {
+    "OpenShift": {
+        "OpenShift CPU": 0.013,
+        "OpenShift GPUA100": 1.803,
+        "OpenShift GPUA100SXM4": 2.078,
+        "OpenShift GPUV100": 1.214,
+    },
+    "OpenStack": {
+        "OpenStack CPU": 0.013,
+        "OpenStack GPUA100": 1.803,
+        "OpenStack GPUA100SXM4": 2.078,
+        "OpenStack GPUK80": 0.463,
+    },
+    "Storage": {
+        "OpenShift Storage": 0.000009,
+        "OpenStack Storage": 0.000009,
+    },
+}
+INVOICE_COLUMNS = [
+    process_report.INVOICE_DATE_FIELD,
+    process_report.PROJECT_FIELD,
+    process_report.PROJECT_ID_FIELD,
+    process_report.PI_FIELD,
+    process_report.INVOICE_EMAIL_FIELD,
+    process_report.INVOICE_ADDRESS_FIELD,
+    process_report.INSTITUTION_FIELD,
+    process_report.INSTITUTION_ID_FIELD,
+    process_report.SU_HOURS_FIELD,
+    process_report.SU_TYPE_FIELD,
+    "Rate",
+    process_report.COST_FIELD,
+]
+LEDGER_COLUMNS = [
+    process_report.PI_PI_FIELD,
+    process_report.PI_FIRST_MONTH,
+    process_report.PI_INITIAL_CREDITS,
+    process_report.PI_1ST_USED,
+    process_report.PI_2ND_USED,
+]
+
+
+def generate_invoices(
+    output_dir,
+    rows=10000,
+    pis=500,
+    projects=2000,
+    su_types=None,
+    institutions=8,
+    alias_fraction=0.05,
+    nonbillable_fraction=0.02,
+    new_pi_fraction=0.1,
+    invoice_month="2024-03",
+    seed=0,
+):
+    """Writes synthetic invoices of `invoice_month` to `output_dir`, and returns
+    the paths of the files written, by their `main` argument
+
+    `rows` are split between the OpenShift, OpenStack and Storage invoices, as
+    the SU types they bill, which can be narrowed to `su_types`. Each of the
+    `projects` belongs to one of the `pis`, whose email domains are taken from
+    the first `institutions` of the institute map. Each row's hours are drawn
+    from a heavy tailed distribution, and its cost is the hours times its SU
+    type's rate.
+
+    `alias_fraction` of the PIs also bill under an alias, and
+    `nonbillable_fraction` of the PIs and projects are listed as non-billable,
+    with a few more projects only non-billable for some months. The PI ledger
+    holds every PI except `new_pi_fraction` of them, with first invoice months
+    and credits used over the previous year.
+    """
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    month = pandas.Period(invoice_month, "M")
+
+    domains = list(process_report.load_institute_map())[:institutions]
+    pi_names = numpy.array(
+        [f"pi{i}@{domains[i % len(domains)]}" for i in range(pis)], dtype=object
+    )
+    pi_aliases = numpy.array(
+        [f"pi{i}@alias.{name.split('@')[1]}" for i, name in enumerate(pi_names)],
+        dtype=object,
+    )
+    has_alias = rng.random(pis) < alias_fraction
+    project_pis = numpy.concatenate(
+        [numpy.arange(min(pis, projects)), rng.integers(0, pis, max(projects - pis, 0))]
+    )
+    # A few PIs have most of the projects, as in the real invoices
+    project_weights = rng.pareto(1.5, projects) + 1
+    project_weights /= project_weights.sum()
+
+    paths["csv_files"] = []
+    service_rows = numpy.bincount(
+        rng.choice(len(SERVICES), rows, p=[0.45, 0.35, 0.2]), minlength=len(SERVICES)
+    )
+    row_id = 0
+    for (service, rates), service_row_count in zip(SERVICES.items(), service_rows):
+        if su_types is not None:
+            rates = {su: rate for su, rate in rates.items() if su in su_types}
+        if not rates or not service_row_count:
+            continue
+        row_projects = rng.choice(projects, service_row_count, p=project_weights)
+        row_pis = project_pis[row_projects]
+        row_pi_names = numpy.where(
+            has_alias[row_pis] & (rng.random(service_row_count) < 0.5),
+            pi_aliases[row_pis],
+            pi_names[row_pis],
+        )
+        row_su_types = rng.choice(list(rates), service_row_count)
+        row_rates = numpy.array([rates[su] for su in row_su_types])
+        hours = numpy.ceil(rng.lognormal(4, 2, service_row_count)).astype(int)
+        if service == "Storage":
+            hours *= 1024
+        invoice = pandas.DataFrame(
+            {
+                process_report.INVOICE_DATE_FIELD: invoice_month,
+                process_report.PROJECT_FIELD: [
+                    get_allocation(project, service) for project in row_projects
+                ],
+                process_report.PROJECT_ID_FIELD: [
+                    f"{row_id + i:08x}" for i in range(service_row_count)
+                ],
+                process_report.PI_FIELD: row_pi_names,
+                process_report.INVOICE_EMAIL_FIELD: None,
+                process_report.INVOICE_ADDRESS_FIELD: None,
+                process_report.INSTITUTION_FIELD: None,
+                process_report.INSTITUTION_ID_FIELD: None,
+                process_report.SU_HOURS_FIELD: hours,
+                process_report.SU_TYPE_FIELD: row_su_types,
+                "Rate": row_rates,
+                process_report.COST_FIELD: numpy.char.mod("%.2f", hours * row_rates),
+            },
+            columns=INVOICE_COLUMNS,
+        )
+        row_id += service_row_count
+        invoice_file = os.path.join(output_dir, f"{service} {invoice_month}.csv")
+        invoice.to_csv(invoice_file, index=False)
+        paths["csv_files"].append(invoice_file)
+
+    paths["alias_file"] = os.path.join(output_dir, "alias.csv")
+    with open(paths["alias_file"], "w") as f:
+        for pi in numpy.flatnonzero(has_alias):
+            f.write(f"{pi_names[pi]},{pi_aliases[pi]}\n")
+
+    nonbillable_pis = rng.choice(pis, int(pis * nonbillable_fraction), replace=False)
+    paths["pi_file"] = os.path.join(output_dir, "pi.txt")
+    with open(paths["pi_file"], "w") as f:
+        f.writelines(f"{pi_names[pi]}\n" for pi in sorted(nonbillable_pis))
+
+    nonbillable_projects = rng.choice(
+        projects, int(projects * nonbillable_fraction) * 2, replace=False
+    )
+    listed_projects, timed_projects = numpy.array_split(nonbillable_projects, 2)
+    paths["projects_file"] = os.path.join(output_dir, "projects.txt")
+    with open(paths["projects_file"], "w") as f:
+        for project in sorted(listed_projects):
+            f.writelines(
+                f"{get_allocation(project, service)}\n" for service in SERVICES
+            )
+
+    # Half of the timed projects are non-billable this month, the others ended
+    timed_projects = numpy.repeat(timed_projects, len(SERVICES))
+    start_months = rng.integers(0, 12, len(timed_projects))
+    end_months = rng.integers(1, 12, len(timed_projects))
+    end_months[len(end_months) // 2 :] *= -1
+    paths["timed_projects_file"] = os.path.join(output_dir, "timed_projects.csv")
+    pandas.DataFrame(
+        {
+            "PI": pi_names[project_pis[timed_projects]],
+            "Project": [
+                get_allocation(project, service)
+                for project, service in zip(
+                    timed_projects,
+                    list(SERVICES) * (len(timed_projects) // len(SERVICES)),
+                )
+            ],
+            "Start Date": [str(month - int(months)) for months in start_months],
+            "End Date": [str(month + int(months)) for months in end_months],
+            "Reason": "Internal",
+        }
+    ).to_csv(paths["timed_projects_file"], index=False)
+
+    old_pis = rng.random(pis) >= new_pi_fraction
+    first_months = [
+        str(month - int(months_ago))
+        for months_ago in rng.integers(1, 24, old_pis.sum())
+    ]
+    credits_used = rng.choice([0, 250, 500, 1000], (old_pis.sum(), 2))
+    paths["old_pi_file"] = os.path.join(output_dir, "PI.csv")
+    pandas.DataFrame(
+        {
+            process_report.PI_PI_FIELD: pi_names[old_pis],
+            process_report.PI_FIRST_MONTH: first_months,
+            process_report.PI_INITIAL_CREDITS: 1000,
+            process_report.PI_1ST_USED: credits_used[:, 0],
+            process_report.PI_2ND_USED: credits_used[:, 1],
+        },
+        columns=LEDGER_COLUMNS,
+    ).to_csv(paths["old_pi_file"], index=False)
+
+    return paths
+
+
+def get_allocation(project, service):
+    """Returns the name of `project`'s allocation on `service`"""
+    return f"project{project}-{service.lower()}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--pis", type=int, default=500)
+    parser.add_argument("--projects", type=int, default=2000)
+    parser.add_argument(
+        "--su-types", nargs="+", help="Only bill these SU types (default: all)"
+    )
+    parser.add_argument("--institutions", type=int, default=8)
+    parser.add_argument("--alias-fraction", type=float, default=0.05)
+    parser.add_argument("--nonbillable-fraction", type=float, default=0.02)
+    parser.add_argument("--new-pi-fraction", type=float, default=0.1)
+    parser.add_argument("--invoice-month", default="2024-03")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate_invoices(
+        args.output_dir,
+        rows=args.rows,
+        pis=args.pis,
+        projects=args.projects,
+        su_types=args.su_types,
+        institutions=args.institutions,
+        alias_fraction=args.alias_fraction,
+        nonbillable_fraction=args.nonbillable_fraction,
+        new_pi_fraction=args.new_pi_fraction,
+        invoice_month=args.invoice_month,
+        seed=args.seed,
+    )
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+
+
+if __name__ == "__main__":
+    main()
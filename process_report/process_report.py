@@ -1,13 +1,36 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import hashlib
+import io
 import os
+import pstats
+import re
+import resource
+import shutil
+import sqlite3
 import sys
+import tempfile
 import datetime
+import time
+import tracemalloc
+import functools
 from decimal import Decimal
 
 import json
+import numpy
 import pandas
 import boto3
+import boto3.exceptions
+import botocore.config
+import botocore.exceptions
 import pyarrow
+import pyarrow.compute
+import pyarrow.csv
+import pyarrow.ipc
+import pyarrow.parquet
 
 
 ### PI file field names
@@ -16,6 +39,14 @@ PI_FIRST_MONTH = "First Invoice Month"
 PI_INITIAL_CREDITS = "Initial Credits"
 PI_1ST_USED = "1st Month Used"
 PI_2ND_USED = "2nd Month Used"
+
+PI_LEDGER_DTYPES = {
+    PI_INITIAL_CREDITS: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
+    PI_1ST_USED: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
+    PI_2ND_USED: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
+}
+PI_LEDGER_DB_EXTENSIONS = (".db", ".sqlite")
+PI_LEDGER_DB_TABLE = "pis"
 ###
 
 
@@ -37,15 +68,96 @@ SUBSIDY_FIELD = "Subsidy"
 BALANCE_FIELD = "Balance"
 ###
 
+### Invoice field types
+# Low-cardinality fields are categoricals, and credits and subsidies are Python
+# Decimals, as whole amounts taken from a credit or subsidy budget are written
+# without cents. All other fields are Arrow-backed.
+INVOICE_DTYPES = {
+    INVOICE_DATE_FIELD: "category",
+    PROJECT_FIELD: pandas.ArrowDtype(pyarrow.string()),
+    PROJECT_ID_FIELD: pandas.ArrowDtype(pyarrow.string()),
+    PI_FIELD: pandas.ArrowDtype(pyarrow.string()),
+    INVOICE_EMAIL_FIELD: pandas.ArrowDtype(pyarrow.string()),
+    INVOICE_ADDRESS_FIELD: pandas.ArrowDtype(pyarrow.string()),
+    INSTITUTION_FIELD: "category",
+    INSTITUTION_ID_FIELD: pandas.ArrowDtype(pyarrow.string()),
+    SU_HOURS_FIELD: pandas.ArrowDtype(pyarrow.float64()),
+    SU_TYPE_FIELD: "category",
+    COST_FIELD: pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+    CREDIT_FIELD: "object",
+    CREDIT_CODE_FIELD: "category",
+    SUBSIDY_FIELD: "object",
+    BALANCE_FIELD: pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+}
+# Fields kept as integers, rather than their type above, while every invoice
+# lists them as whole numbers without gaps, as `pandas.read_csv` infers them
+INVOICE_INTEGER_DTYPES = {SU_HOURS_FIELD: pandas.ArrowDtype(pyarrow.int64())}
+###
+
+CENTS_PER_DOLLAR = 100
+
+EXPORT_CHUNK_ROWS = 1 << 16
+
+CSV_WRITERS = ("arrow", "pandas")
+OUTPUT_FORMATS = ("csv", "csv.gz", "csv.zst", "parquet")
+OUTPUT_COMPRESSION = {"csv.gz": "gzip", "csv.zst": "zstd"}
+# Like `DataFrame.to_csv`, values are only quoted if they contain one of these
+CSV_QUOTE_PATTERN = "[" + re.escape(',"' + os.linesep) + "]"
+
+INSTITUTE_MAP_FILE = os.path.join(os.path.dirname(__file__), "institute_map.json")
+
+### Non-billable exclusion rules
+EXCLUDED_BY_PI = "PI"
+EXCLUDED_BY_PROJECT = "project"
+EXCLUDED_BY_TIMED_PROJECT = "timed project"
+###
+
 PI_S3_FILEPATH = "PIs/PI.csv"
+PI_DB_S3_FILEPATH = "PIs/PI.db"
 
 
 ALIAS_S3_FILEPATH = "PIs/alias.csv"
+ALIAS_LOCAL_FILE = "alias.csv"
+
+# Size of the S3 client's connection pool, and so the number of concurrent downloads
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 16))
+# Directory of the S3 download cache, if any
+S3_CACHE_DIR = os.environ.get("S3_CACHE_DIR")
+S3_ATTEMPTS = 5
+# Seconds to wait before retrying a failed S3 request, doubled after each attempt
+S3_RETRY_DELAY = 0.5
+S3_RETRIED_ERRORS = (
+    botocore.exceptions.BotoCoreError,
+    botocore.exceptions.ClientError,
+    boto3.exceptions.S3UploadFailedError,
+)
+
+# A step of the invoice processing, run by `run_stages` once the values named
+# by `inputs` and the stages named by `after` are done. `function` is called
+# with the inputs, and returns the values named by `outputs`.
+Stage = collections.namedtuple(
+    "Stage", ["name", "function", "inputs", "outputs", "after"], defaults=[(), (), ()]
+)
+# Number of functions with the most own time printed for each profiled stage
+PROFILE_TOP_FUNCTIONS = 10
 
 
 def get_institution_from_pi(institute_map, pi_uname):
-    institution_key = pi_uname.split("@")[-1]
-    institution_name = institute_map.get(institution_key, "")
+    """Returns the institution name of a PI, or an empty string if it is unknown
+
+    If the PI's username is an email address, its domain is matched against
+    `institute_map` by longest suffix, so "foo@cs.bu.edu" matches "bu.edu" unless
+    "cs.bu.edu" is itself in the map. Other usernames must match exactly.
+    """
+    institution_name = ""
+    if "@" in pi_uname:
+        domain_labels = pi_uname.split("@")[-1].lower().split(".")
+        for i in range(len(domain_labels)):
+            institution_name = institute_map.get(".".join(domain_labels[i:]), "")
+            if institution_name != "":
+                break
+    else:
+        institution_name = institute_map.get(pi_uname.lower(), "")
 
     if institution_name == "":
         print(f"Warning: PI name {pi_uname} does not match any institution!")
@@ -53,38 +165,171 @@ def get_institution_from_pi(institute_map, pi_uname):
     return institution_name
 
 
+def get_institutions_from_pis(pis, institute_map=None) -> pandas.Categorical:
+    """Returns the institution name of every PI in `pis`
+
+    Each distinct PI is only resolved once. Missing PIs get a missing institution.
+    `institute_map` defaults to `get_institute_domain_index()`.
+    """
+    if institute_map is None:
+        institute_map = get_institute_domain_index()
+
+    pi_codes, pi_names = pandas.factorize(pis)
+    institution_codes, institution_names = pandas.factorize(
+        pandas.Series(
+            [get_institution_from_pi(institute_map, pi_name) for pi_name in pi_names],
+            dtype="object",
+        )
+    )
+    # Missing PIs have code -1, which picks the appended missing value
+    institution_codes = numpy.append(institution_codes, -1)
+    return pandas.Categorical.from_codes(
+        institution_codes[pi_codes], categories=institution_names
+    )
+
+
+@functools.lru_cache(maxsize=None)
 def load_institute_map() -> dict:
-    with open("process_report/institute_map.json", "r") as f:
+    with open(INSTITUTE_MAP_FILE, "r") as f:
         institute_map = json.load(f)
 
     return institute_map
 
 
-def load_old_pis(old_pi_file) -> pandas.DataFrame:
+@functools.lru_cache(maxsize=None)
+def get_institute_domain_index() -> dict:
+    """Returns the institute map keyed by lowercase domain, built once per process"""
+    return {domain.lower(): name for domain, name in load_institute_map().items()}
+
+
+def is_pi_ledger_db(old_pi_file) -> bool:
+    """Returns whether the PI ledger is kept in an SQLite database rather than a csv"""
+    return os.path.splitext(old_pi_file)[1] in PI_LEDGER_DB_EXTENSIONS
+
+
+def _connect_pi_ledger_db(old_pi_file, create=False):
+    if not create and not os.path.exists(old_pi_file):
+        raise FileNotFoundError(old_pi_file)
+    connection = sqlite3.connect(old_pi_file)
+    connection.execute(
+        f'CREATE TABLE IF NOT EXISTS {PI_LEDGER_DB_TABLE} ("{PI_PI_FIELD}" TEXT PRIMARY KEY, '
+        f'"{PI_FIRST_MONTH}" TEXT, "{PI_INITIAL_CREDITS}" TEXT, '
+        f'"{PI_1ST_USED}" TEXT, "{PI_2ND_USED}" TEXT)'
+    )
+    connection.execute(
+        f"CREATE INDEX IF NOT EXISTS {PI_LEDGER_DB_TABLE}_first_month "
+        f'ON {PI_LEDGER_DB_TABLE} ("{PI_FIRST_MONTH}")'
+    )
+    return connection
+
+
+def load_old_pis(old_pi_file, pis=None, invoice_month=None) -> pandas.DataFrame:
+    """Loads the New PI credit ledger, indexed by PI
+
+    An SQLite ledger only reads the entries of `pis` and of the PIs first billed in
+    `invoice_month`, so that the amount read scales with the PIs billed this month.
+    A csv ledger is always read in full."""
     try:
-        old_pi_df = pandas.read_csv(
-            old_pi_file,
-            dtype={
-                PI_INITIAL_CREDITS: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
-                PI_1ST_USED: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
-                PI_2ND_USED: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
-            },
-        )
+        if is_pi_ledger_db(old_pi_file):
+            old_pi_df = _load_old_pis_db(old_pi_file, pis, invoice_month)
+        else:
+            old_pi_df = pandas.read_csv(
+                old_pi_file,
+                index_col=PI_PI_FIELD,
+                dtype=PI_LEDGER_DTYPES,
+            )
     except FileNotFoundError:
         sys.exit("Applying credit 0002 failed. Old PI file does not exist")
 
     return old_pi_df
 
 
+def _load_old_pis_db(old_pi_file, pis, invoice_month) -> pandas.DataFrame:
+    with contextlib.closing(_connect_pi_ledger_db(old_pi_file)) as connection:
+        if pis is None:
+            query = f"SELECT * FROM {PI_LEDGER_DB_TABLE} ORDER BY rowid"
+            params = ()
+        else:
+            connection.execute("CREATE TEMP TABLE billed_pis (pi TEXT PRIMARY KEY)")
+            connection.executemany(
+                "INSERT OR IGNORE INTO billed_pis VALUES (?)", ((pi,) for pi in pis)
+            )
+            query = (
+                f"SELECT * FROM {PI_LEDGER_DB_TABLE} "
+                f'WHERE "{PI_PI_FIELD}" IN (SELECT pi FROM billed_pis) '
+                f'OR "{PI_FIRST_MONTH}" = ? ORDER BY rowid'
+            )
+            params = (invoice_month,)
+        old_pi_df = pandas.read_sql_query(
+            query, connection, params=params, index_col=PI_PI_FIELD
+        )
+    return old_pi_df.astype(PI_LEDGER_DTYPES)
+
+
 def dump_old_pis(old_pi_file, old_pi_df: pandas.DataFrame):
-    old_pi_df = old_pi_df.astype(
-        {
-            PI_INITIAL_CREDITS: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
-            PI_1ST_USED: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
-            PI_2ND_USED: pandas.ArrowDtype(pyarrow.decimal128(21, 2)),
-        },
+    old_pi_df = old_pi_df.astype(PI_LEDGER_DTYPES)
+    if is_pi_ledger_db(old_pi_file):
+        with contextlib.closing(
+            _connect_pi_ledger_db(old_pi_file, create=True)
+        ) as connection, connection:
+            connection.execute(f"DELETE FROM {PI_LEDGER_DB_TABLE}")
+            _insert_old_pis_db(connection, old_pi_df)
+    else:
+        old_pi_df.to_csv(old_pi_file)
+
+
+def _insert_old_pis_db(connection, old_pi_df: pandas.DataFrame):
+    columns = [PI_FIRST_MONTH, PI_INITIAL_CREDITS, PI_1ST_USED, PI_2ND_USED]
+    rows = _to_db_text(old_pi_df[columns]).itertuples(name=None)
+    connection.executemany(
+        f"INSERT INTO {PI_LEDGER_DB_TABLE} VALUES (?, ?, ?, ?, ?)", rows
     )
-    old_pi_df.to_csv(old_pi_file, index=False)
+
+
+def _to_db_text(values):
+    """Returns `values` as text, with missing values as None so they are stored as NULL"""
+    return values.astype("str").mask(values.isna(), None)
+
+
+def update_old_pis(
+    old_pi_file, old_pi_df: pandas.DataFrame, new_pi_df: pandas.DataFrame, credits_used
+):
+    """Records this month's new PIs and the credits each PI used
+
+    `credits_used` maps a used-credits field to a Series of its changed values,
+    indexed by PI. An SQLite ledger is updated in place in a single transaction,
+    only touching those rows, while a csv ledger is rewritten in full."""
+    if not is_pi_ledger_db(old_pi_file):
+        old_pi_df = pandas.concat([old_pi_df, new_pi_df.astype(old_pi_df.dtypes)])
+        for credit_used_field, pi_credits_used in credits_used.items():
+            old_pi_df.loc[pi_credits_used.index, credit_used_field] = pi_credits_used
+        dump_old_pis(old_pi_file, old_pi_df)
+        return
+
+    with contextlib.closing(
+        _connect_pi_ledger_db(old_pi_file)
+    ) as connection, connection:
+        _insert_old_pis_db(connection, new_pi_df.astype(PI_LEDGER_DTYPES))
+        for credit_used_field, pi_credits_used in credits_used.items():
+            pi_credits_used = pi_credits_used.astype(
+                PI_LEDGER_DTYPES[credit_used_field]
+            )
+            connection.executemany(
+                f'UPDATE {PI_LEDGER_DB_TABLE} SET "{credit_used_field}" = ? '
+                f'WHERE "{PI_PI_FIELD}" = ?',
+                zip(_to_db_text(pi_credits_used), pi_credits_used.index),
+            )
+
+
+def convert_old_pis(source_file, destination_file):
+    """Copies a PI ledger between the csv and SQLite formats, chosen by file extension"""
+    dump_old_pis(destination_file, load_old_pis(source_file))
+
+
+def load_name_list(list_file):
+    """Returns the names listed in `list_file`, one per line"""
+    with open(list_file) as file:
+        return [line.rstrip() for line in file]
 
 
 def load_alias(alias_file):
@@ -107,27 +352,47 @@ def get_pi_age(old_pi_df: pandas.DataFrame, pi, invoice_month):
     I.e 0 for new PIs
 
     Will raise an error if the PI'a age is negative, which suggests a faulty invoice, or a program bug"""
-    first_invoice_month = old_pi_df.loc[old_pi_df[PI_PI_FIELD] == pi, PI_FIRST_MONTH]
-    if first_invoice_month.empty:
-        return 0
-
-    month_diff = get_month_diff(invoice_month, first_invoice_month.iat[0])
-    if month_diff < 0:
-        sys.exit(
-            f"PI {pi} from {first_invoice_month} found in {invoice_month} invoice!"
-        )
-    else:
-        return month_diff
+    return int(get_pi_ages(old_pi_df, [pi], invoice_month)[0])
+
+
+def get_pi_ages(old_pi_df: pandas.DataFrame, pis, invoice_month):
+    """Returns the age of each of `pis`, as `get_pi_age` does, in one pass
+    over the PI ledger"""
+    first_months = old_pi_df.loc[~old_pi_df.index.duplicated(), PI_FIRST_MONTH]
+    first_months = first_months.reindex(pis)
+    known = first_months.notna().to_numpy()
+
+    pi_ages = numpy.zeros(len(first_months), dtype=numpy.int64)
+    pi_ages[known] = get_month_ordinals(invoice_month) - get_month_ordinals(
+        first_months[known]
+    )
+    if (pi_ages < 0).any():
+        pi = first_months.index[pi_ages.argmin()]
+        sys.exit(f"PI {pi} from {first_months[pi]} found in {invoice_month} invoice!")
+    return pi_ages
+
+
+def get_month_ordinals(months):
+    """Returns "YYYY-MM" months as integer month counts, so that subtracting
+    two gives the number of months between them"""
+    if isinstance(months, str):
+        date = pandas.to_datetime(months, format="%Y-%m")
+        return date.year * 12 + date.month
+    dates = pandas.to_datetime(pandas.Index(months), format="%Y-%m")
+    return numpy.asarray(dates.year * 12 + dates.month, dtype=numpy.int64)
 
 
 def get_month_diff(month_1, month_2):
     """Returns a positive integer if month_1 is ahead in time of month_2"""
-    dt1 = datetime.datetime.strptime(month_1, "%Y-%m")
-    dt2 = datetime.datetime.strptime(month_2, "%Y-%m")
-    return (dt1.year - dt2.year) * 12 + (dt1.month - dt2.month)
+    return get_month_ordinals(month_1) - get_month_ordinals(month_2)
 
 
+@functools.lru_cache(maxsize=None)
 def get_invoice_bucket():
+    """Returns the invoice bucket, created once per process
+
+    Every fetch and upload shares its client and connection pool, which holds
+    `S3_MAX_POOL_CONNECTIONS` connections."""
     try:
         s3_resource = boto3.resource(
             service_name="s3",
@@ -136,20 +401,361 @@ def get_invoice_bucket():
             ),
             aws_access_key_id=os.environ["S3_KEY_ID"],
             aws_secret_access_key=os.environ["S3_APP_KEY"],
+            config=botocore.config.Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
         )
     except KeyError:
         print("Error: Please set the environment variables S3_KEY_ID and S3_APP_KEY")
     return s3_resource.Bucket(os.environ.get("S3_BUCKET_NAME", "nerc-invoicing"))
 
 
+def download_s3_files(
+    downloads, jobs=S3_MAX_POOL_CONNECTIONS, cache_dir=None, cache_max_size=2**30
+):
+    """Downloads each `(key, local_name)` of `downloads` from the invoice bucket,
+    `jobs` at a time, and returns the local names
+
+    If `cache_dir` is given, objects are kept there under their key, ETag and
+    size, which are looked up with a HEAD request, and are only transferred
+    again once they change. Least recently used objects are evicted once the
+    cache grows beyond `cache_max_size` bytes."""
+    if not downloads:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = submit_s3_downloads(executor, downloads, cache_dir)
+        local_names = [future.result() for future in futures]
+
+    if cache_dir is not None:
+        evict_cache(cache_dir, cache_max_size, ".s3")
+    return local_names
+
+
+def submit_s3_downloads(executor, downloads, cache_dir=None):
+    """Starts downloading each `(key, local_name)` of `downloads` on `executor`,
+    as `download_s3_files` does, and returns a future of each local name"""
+    get_invoice_bucket()
+    return [
+        executor.submit(_download_s3_file, key, local_name, cache_dir)
+        for key, local_name in downloads
+    ]
+
+
+def _download_s3_file(key, local_name, cache_dir):
+    if cache_dir is None:
+        get_invoice_bucket().download_file(key, local_name)
+    else:
+        shutil.copyfile(_download_s3_cached(key, cache_dir), local_name)
+    return local_name
+
+
+def _download_s3_cached(key, cache_dir):
+    """Returns the path of the cached copy of `key`, downloading it if missing"""
+    invoice_bucket = get_invoice_bucket()
+    head = invoice_bucket.meta.client.head_object(Bucket=invoice_bucket.name, Key=key)
+    cache_key = hashlib.sha256(
+        json.dumps(
+            [invoice_bucket.name, key, head["ETag"], head["ContentLength"]]
+        ).encode()
+    ).hexdigest()
+    cache_file = os.path.join(cache_dir, f"{cache_key}.s3")
+
+    if os.path.exists(cache_file):
+        os.utime(cache_file)
+        return cache_file
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_cache_file = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+    try:
+        # The request fails if the object changed since the HEAD request.
+        # `download_file` doesn't take IfMatch, so the body is streamed instead.
+        with open(fd, "wb") as f:
+            response = invoice_bucket.meta.client.get_object(
+                Bucket=invoice_bucket.name, Key=key, IfMatch=head["ETag"]
+            )
+            with contextlib.closing(response["Body"]) as body:
+                shutil.copyfileobj(body, f)
+        os.replace(tmp_cache_file, cache_file)
+    finally:
+        if os.path.exists(tmp_cache_file):
+            os.remove(tmp_cache_file)
+    return cache_file
+
+
+def upload_s3_files(uploads, jobs=S3_MAX_POOL_CONNECTIONS):
+    """Uploads each `(source, key, archive_key)` of `uploads` to the invoice
+    bucket, `jobs` at a time, and returns how long each one took in seconds
+
+    The source is either a local file or a `pyarrow.Buffer` holding the file,
+    which is streamed from memory in multipart uploads as large as a file's.
+    Each file is only uploaded to `key`, and S3 then copies it to `archive_key`
+    if given. Failed requests are retried up to `S3_ATTEMPTS` times."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = submit_s3_uploads(executor, uploads)
+        return [future.result() for future in futures]
+
+
+def submit_s3_uploads(executor, uploads):
+    """Starts uploading each `(source, key, archive_key)` of `uploads` on
+    `executor`, as `upload_s3_files` does, and returns a future of each upload's
+    time in seconds"""
+    get_invoice_bucket()
+    return [executor.submit(_upload_s3_file, *upload) for upload in uploads]
+
+
+def _upload_s3_file(source, key, archive_key):
+    invoice_bucket = get_invoice_bucket()
+    start = time.perf_counter()
+    _retry_s3_request(_put_s3_object, source, key)
+    if archive_key is not None:
+        _retry_s3_request(
+            invoice_bucket.meta.client.copy_object,
+            Bucket=invoice_bucket.name,
+            Key=archive_key,
+            CopySource={"Bucket": invoice_bucket.name, "Key": key},
+        )
+    return time.perf_counter() - start
+
+
+def _put_s3_object(source, key):
+    if isinstance(source, pyarrow.Buffer):
+        # Every attempt reads the buffer from its start
+        get_invoice_bucket().upload_fileobj(pyarrow.BufferReader(source), key)
+    else:
+        get_invoice_bucket().upload_file(source, key)
+
+
+def _retry_s3_request(request, *args, **kwargs):
+    for attempt in range(S3_ATTEMPTS):
+        try:
+            return request(*args, **kwargs)
+        except S3_RETRIED_ERRORS as e:
+            if attempt == S3_ATTEMPTS - 1:
+                raise
+            delay = S3_RETRY_DELAY * 2**attempt
+            print(f"Retrying S3 request in {delay}s after error: {e}")
+            time.sleep(delay)
+
+
 def get_iso8601_time():
     return datetime.datetime.now().strftime("%Y%m%dT%H%M%SZ")
 
 
+def run_stages(stages, values=None, jobs=1, trace_memory=False, profile_dir=None):
+    """Runs each of `stages` once its inputs are in `values`, `jobs` at a time,
+    and returns the metrics of each stage in the order they finished
+
+    When several stages are ready, they are started in the order of `stages`.
+    Inputs are removed from `values` once no remaining stage takes them, so
+    their memory is freed as soon as possible. The metrics of a stage are its
+    start and wall time, the CPU time of the thread that ran it, the rows of
+    the dataframes it returned, the peak of the memory traced by tracemalloc if
+    `trace_memory` is set, and the peak RSS of the process. Stages running at
+    the same time share the traced peak.
+
+    If `profile_dir` is given, each stage is profiled as by `profile_stage`.
+    The stages then run one at a time, so that each profile only holds its
+    own stage."""
+    values = {} if values is None else values
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        jobs = 1
+    pending = list(stages)
+    consumed = {name for stage in stages for name in stage.inputs}
+    done = set()
+    running = {}
+    metrics = []
+    run_start = time.perf_counter()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    if len(running) == jobs:
+                        break
+                    if all(name in values for name in stage.inputs) and all(
+                        name in done for name in stage.after
+                    ):
+                        pending.remove(stage)
+                        inputs = [values[name] for name in stage.inputs]
+                        future = executor.submit(
+                            _run_stage,
+                            stage,
+                            inputs,
+                            run_start,
+                            trace_memory,
+                            profile_dir,
+                        )
+                        running[future] = stage
+                if not running:
+                    raise ValueError(
+                        "Stages with missing inputs: "
+                        + ", ".join(stage.name for stage in pending)
+                    )
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    stage = running.pop(future)
+                    results, stage_metrics = future.result()
+                    values.update(zip(stage.outputs, results))
+                    done.add(stage.name)
+                    metrics.append(stage_metrics)
+                del finished, future, results
+
+                needed = {name for stage in pending for name in stage.inputs}
+                for name in consumed - needed:
+                    values.pop(name, None)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return metrics
+
+
+def _run_stage(stage, inputs, run_start, trace_memory, profile_dir):
+    if trace_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    if profile_dir is None:
+        results = stage.function(*inputs)
+    else:
+        results = profile_stage(stage, inputs, profile_dir)
+    cpu_time = time.thread_time() - cpu_start
+    wall_time = time.perf_counter() - start
+
+    if len(stage.outputs) == 1:
+        results = (results,)
+    elif not stage.outputs:
+        results = ()
+    rows = [len(result) for result in results if isinstance(result, pandas.DataFrame)]
+    return results, {
+        "stage": stage.name,
+        "start": start - run_start,
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "rows": sum(rows) if rows else None,
+        "peak_memory": tracemalloc.get_traced_memory()[1] if trace_memory else None,
+        # Kilobytes on Linux
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def profile_stage(stage, inputs, profile_dir):
+    """Calls the function of `stage` with `inputs` under cProfile, and returns
+    its results
+
+    The profile is written to `profile_dir` as `{stage}.prof`, to be read with
+    `pstats`, and as the collapsed stacks `{stage}.folded`, which flamegraph.pl
+    and speedscope draw as flame graphs. The functions with the most own time
+    are printed."""
+    profiler = cProfile.Profile()
+    try:
+        results = profiler.runcall(stage.function, *inputs)
+    finally:
+        stats = pstats.Stats(profiler)
+        stats.dump_stats(os.path.join(profile_dir, f"{stage.name}.prof"))
+        write_collapsed_stacks(stats, os.path.join(profile_dir, f"{stage.name}.folded"))
+
+        print(f"Hottest functions of stage {stage.name}:")
+        print(f"{'Own (s)':>9} {'Total (s)':>9} {'Calls':>9}  Function")
+        top_functions = sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )[:PROFILE_TOP_FUNCTIONS]
+        for function, (_, calls, own_time, total_time, _) in top_functions:
+            print(
+                f"{own_time:>9.3f} {total_time:>9.3f} {calls:>9}"
+                f"  {pstats.func_std_string(function)}"
+            )
+    return results
+
+
+def write_collapsed_stacks(stats: pstats.Stats, output_file):
+    """Writes the own time of the functions in `stats` as collapsed stacks, in
+    microseconds
+
+    cProfile only records the time each function spent called from each of
+    its callers, so a function's time under a caller is split between that
+    caller's stacks in proportion to their share of the caller's time.
+    Recursive calls are folded into the first call, and stacks of less than a
+    microsecond are left out."""
+    callees = collections.defaultdict(dict)
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][function] = caller_stats[3]
+
+    stacks = collections.Counter()
+
+    def add_stacks(function, stack, share):
+        """Adds the stacks of `function` called at the end of `stack`, which
+        holds `share` of its time"""
+        stack = stack + (function,)
+        stacks[stack] += share * stats.stats[function][2]
+        for callee, callee_time in callees[function].items():
+            if callee in stack or share * callee_time < 1e-6:
+                continue
+            add_stacks(callee, stack, share * callee_time / stats.stats[callee][3])
+
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            add_stacks(function, (), 1.0)
+
+    lines = collections.Counter()
+    for stack, own_time in stacks.items():
+        frames = [pstats.func_std_string(function) for function in stack]
+        lines[";".join(frames).replace("\n", " ")] += own_time
+    with open(output_file, "w") as f:
+        for line, own_time in sorted(lines.items()):
+            microseconds = round(own_time * 1e6)
+            if microseconds:
+                f.write(f"{line} {microseconds}\n")
+
+
+def print_stage_summary(metrics, wall_time):
+    """Prints a table of the metrics returned by `run_stages`"""
+    print(
+        f"{'Stage':<24} {'Start (s)':>9} {'Wall (s)':>9} {'CPU (s)':>9}"
+        f" {'Rows':>9} {'Peak (MiB)':>10} {'RSS (MiB)':>10}"
+    )
+    for stage in metrics:
+        rows = "" if stage["rows"] is None else stage["rows"]
+        peak_memory = (
+            ""
+            if stage["peak_memory"] is None
+            else f"{stage['peak_memory'] / 2**20:.1f}"
+        )
+        print(
+            f"{stage['stage']:<24} {stage['start']:>9.2f} {stage['wall_time']:>9.2f}"
+            f" {stage['cpu_time']:>9.2f} {rows:>9} {peak_memory:>10}"
+            f" {stage['max_rss'] / 2**20:>10.1f}"
+        )
+    print(f"{'Total':<24} {'':>9} {wall_time:>9.2f}")
+
+
+def write_stage_report(report_file, metrics, wall_time):
+    """Writes the metrics returned by `run_stages` to `report_file` as JSON"""
+    with open(report_file, "w") as f:
+        json.dump({"wall_time": wall_time, "stages": metrics}, f, indent=2)
+        f.write("\n")
+
+
 def main():
     """Remove non-billable PIs and projects"""
 
-    parser = argparse.ArgumentParser()
+    # Converting a PI ledger doesn't process an invoice, so it needs no other argument
+    convert_parser = argparse.ArgumentParser(add_help=False)
+    convert_parser.add_argument(
+        "--convert-old-pi-file",
+        nargs=2,
+        metavar=("SOURCE", "DESTINATION"),
+        help="Converts the PI ledger SOURCE to DESTINATION, between the csv and SQLite formats chosen by their extensions, and exits",
+    )
+    convert_args, _ = convert_parser.parse_known_args()
+    if convert_args.convert_old_pi_file:
+        convert_old_pis(*convert_args.convert_old_pi_file)
+        return
+
+    parser = argparse.ArgumentParser(parents=[convert_parser])
 
     parser.add_argument(
         "csv_files",
@@ -226,13 +832,103 @@ def main():
     parser.add_argument(
         "--old-pi-file",
         required=False,
-        help="Name of csv file listing previously billed PIs. If not provided, defaults to fetching from S3",
+        help="Name of csv file listing previously billed PIs. If not provided, defaults to fetching from S3. A .db or .sqlite file is used as an SQLite ledger, which is updated incrementally",
+    )
+    parser.add_argument(
+        "--old-pi-format",
+        required=False,
+        choices=["csv", "sqlite"],
+        default="csv",
+        help="Format of the PI file fetched from S3 when --old-pi-file is not provided",
     )
     parser.add_argument(
         "--alias-file",
         required=False,
         help="Name of alias file listing PIs with aliases (and their aliases). If not provided, defaults to fetching from S3",
     )
+    parser.add_argument(
+        "--batch-size",
+        required=False,
+        type=int,
+        help="If set, streams the CSV files through the parser this many bytes at a time to bound peak memory",
+    )
+    parser.add_argument(
+        "--jobs",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of worker threads used to parse the CSV files and write the PI invoices",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        required=False,
+        help="If set, caches the merged invoices in this directory and reuses them while the input files are unchanged",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        required=False,
+        type=int,
+        default=2**30,
+        help="Size in bytes beyond which the least recently used cache entries are evicted",
+    )
+    parser.add_argument(
+        "--s3-cache-dir",
+        default=S3_CACHE_DIR,
+        help="Keeps the files fetched from S3 in this directory, and only downloads them again once they change (default: $S3_CACHE_DIR)",
+    )
+    parser.add_argument(
+        "--s3-cache-max-size",
+        type=int,
+        default=2**30,
+        help="Size in bytes beyond which the least recently used S3 cache entries are evicted",
+    )
+    parser.add_argument(
+        "--no-s3-cache",
+        action="store_true",
+        help="Downloads every file from S3, without reading or updating the S3 cache",
+    )
+    parser.add_argument(
+        "--s3-stream-inputs",
+        action="store_true",
+        help="With --fetch-from-s3, parses the invoices as they are downloaded instead of saving them to disk first",
+    )
+    parser.add_argument(
+        "--s3-stream-outputs",
+        action="store_true",
+        help="With --upload-to-s3, keeps the uploaded invoices in memory instead of writing them to disk",
+    )
+    parser.add_argument(
+        "--csv-writer",
+        choices=CSV_WRITERS,
+        default=CSV_WRITERS[0],
+        help="Formats the output invoices with pyarrow compute functions, or with pandas",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMATS[0],
+        help="Format of the output invoices; the extensions of the output file names are changed to match",
+    )
+    parser.add_argument(
+        "--stage-jobs",
+        type=int,
+        default=4,
+        help="Number of processing stages that can run at the same time, such as the exports",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Records the peak memory allocated during each stage with tracemalloc, which slows the run down",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profiles each processing stage with cProfile, writes its pstats dump and collapsed stacks to this directory, and prints its hottest functions. The stages then run one at a time",
+    )
+    parser.add_argument(
+        "--stage-report",
+        help="Writes the time, rows and memory of each processing stage to this file as JSON",
+    )
     parser.add_argument(
         "--BU-subsidy-amount",
         required=True,
@@ -240,102 +936,655 @@ def main():
         help="Amount of subsidy given to BU PIs",
     )
     args = parser.parse_args()
+    if args.s3_stream_inputs and not args.fetch_from_s3:
+        parser.error("--s3-stream-inputs requires --fetch-from-s3")
+    if args.s3_stream_outputs and not args.upload_to_s3:
+        parser.error("--s3-stream-outputs requires --upload-to-s3")
+
+    output_format = args.output_format
+    args.nonbillable_file = with_output_format(args.nonbillable_file, output_format)
+    args.output_file = with_output_format(args.output_file, output_format)
+    args.BU_invoice_file = with_output_format(args.BU_invoice_file, output_format)
+    args.HU_BU_invoice_file = with_output_format(args.HU_BU_invoice_file, output_format)
+    args.Lenovo_file = with_output_format(args.Lenovo_file, output_format)
+
+    # The stages share one bucket, created before they start, as boto3's
+    # default session isn't thread-safe
+    if (
+        args.fetch_from_s3
+        or args.upload_to_s3
+        or not (args.old_pi_file and args.alias_file)
+    ):
+        get_invoice_bucket()
 
-    invoice_month = args.invoice_month
+    # Fetching the inputs and uploading the invoices share this pool
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=S3_MAX_POOL_CONNECTIONS
+    )
+    start = time.perf_counter()
+    metrics = run_stages(
+        get_invoice_stages(args, executor),
+        {},
+        args.stage_jobs,
+        args.trace_memory,
+        args.profile,
+    )
+    wall_time = time.perf_counter() - start
+    executor.shutdown()
 
-    if args.fetch_from_s3:
-        csv_files = fetch_s3_invoices(invoice_month)
-    else:
-        csv_files = args.csv_files
+    print_stage_summary(metrics, wall_time)
+    if args.stage_report:
+        write_stage_report(args.stage_report, metrics, wall_time)
 
-    if args.old_pi_file:
-        old_pi_file = args.old_pi_file
-    else:
-        old_pi_file = fetch_s3_old_pi_file()
 
-    if args.alias_file:
-        alias_file = args.alias_file
-    else:
-        alias_file = fetch_s3_alias_file()
-    alias_dict = load_alias(alias_file)
+def get_invoice_stages(args, executor):
+    """Returns the stages that process the invoices as the arguments of `main` say
 
-    merged_dataframe = merge_csv(csv_files)
+    S3 transfers are submitted to `executor`. Once the PI credits have been
+    applied, and no data error can stop the run anymore, each invoice is
+    uploaded as soon as it is written."""
+    invoice_month = args.invoice_month
+    s3_cache_dir = None if args.no_s3_cache else args.s3_cache_dir
+    # The uploaded invoices are kept here, by file name, instead of on disk
+    output_buffers = {} if args.s3_stream_outputs else None
+    archive_time = get_iso8601_time()
+
+    def fetch_old_pi_file():
+        if args.old_pi_file:
+            return args.old_pi_file
+        key, local_name = get_old_pi_s3_download(args.old_pi_format)
+        return _download_s3_file(key, local_name, s3_cache_dir)
+
+    def fetch_alias():
+        if args.alias_file:
+            return load_alias(args.alias_file)
+        return load_alias(
+            _download_s3_file(ALIAS_S3_FILEPATH, ALIAS_LOCAL_FILE, s3_cache_dir)
+        )
 
-    pi = []
-    projects = []
-    with open(args.pi_file) as file:
-        pi = [line.rstrip() for line in file]
-    with open(args.projects_file) as file:
-        projects = [line.rstrip() for line in file]
+    def load_exclusion_rules():
+        pi = load_name_list(args.pi_file)
+        projects = load_name_list(args.projects_file)
 
-    print("Invoice date: " + str(invoice_month))
+        print("Invoice date: " + str(invoice_month))
 
-    timed_projects_list = timed_projects(args.timed_projects_file, invoice_month)
-    print("The following timed-projects will not be billed for this period: ")
-    print(timed_projects_list)
+        timed_projects_list = timed_projects(args.timed_projects_file, invoice_month)
+        print("The following timed-projects will not be billed for this period: ")
+        print(timed_projects_list)
 
-    projects = list(set(projects + timed_projects_list))
+        return compile_exclusion_rules(pi, projects, timed_projects_list)
 
-    merged_dataframe = validate_pi_aliases(merged_dataframe, alias_dict)
-    merged_dataframe = add_institution(merged_dataframe)
-    export_lenovo(merged_dataframe, args.Lenovo_file)
-    remove_billables(merged_dataframe, pi, projects, args.nonbillable_file)
+    def merge_invoices():
+        if args.s3_stream_inputs:
+            # Streamed invoices can't be hashed for the merged cache without reading them
+            return merge_csv(
+                open_s3_invoices(invoice_month), args.batch_size, args.jobs
+            )
+        csv_files = args.csv_files
+        if args.fetch_from_s3:
+            downloads = submit_s3_downloads(
+                executor, list_s3_invoices(invoice_month), s3_cache_dir
+            )
+            if not args.cache_dir:
+                return merge_csv_as_fetched(downloads, args.batch_size)
+            csv_files = [future.result() for future in downloads]
+        if args.cache_dir:
+            return merge_csv_cached(
+                csv_files,
+                args.cache_dir,
+                args.cache_max_size,
+                args.batch_size,
+                args.jobs,
+            )
+        return merge_csv(csv_files, args.batch_size, args.jobs)
+
+    def partition(dataframe, exclusion_rules):
+        (
+            billable_projects,
+            nonbillable_projects,
+            exclusion_reasons,
+        ) = partition_billables(dataframe, exclusion_rules)
+        for rule, count in exclusion_reasons.value_counts(sort=False).items():
+            print(f"Rows excluded by the non-billable {rule} list: {count}")
+        return billable_projects, nonbillable_projects
+
+    def submit_uploads(names, uploads):
+        return list(zip(names, submit_s3_uploads(executor, uploads)))
+
+    def start_uploads(old_pi_file):
+        invoice_list = [args.nonbillable_file, args.Lenovo_file]
+        uploads = get_invoice_uploads(
+            invoice_list, invoice_month, archive_time, output_buffers
+        )
+        return (
+            submit_uploads(
+                invoice_list + [old_pi_file],
+                uploads + [get_old_pi_upload(old_pi_file)],
+            ),
+            time.perf_counter(),
+        )
 
-    billable_projects = remove_non_billables(merged_dataframe, pi, projects)
-    billable_projects = validate_pi_names(billable_projects)
+    def upload_invoices():
+        invoice_list = [args.output_file] + list_pi_invoices(
+            args.output_folder, output_buffers
+        )
+        uploads = get_invoice_uploads(
+            invoice_list, invoice_month, archive_time, output_buffers
+        )
+        HU_BU_upload = get_HU_BU_upload(
+            args.HU_BU_invoice_file, invoice_month, archive_time, output_buffers
+        )
+        return submit_uploads(
+            invoice_list + [args.HU_BU_invoice_file], uploads + [HU_BU_upload]
+        )
 
-    if args.upload_to_s3:
-        backup_to_s3_old_pi_file(old_pi_file)
-    credited_projects = apply_credits_new_pi(billable_projects, old_pi_file)
+    def finish_uploads(started_uploads, invoice_uploads, upload_start):
+        uploads = started_uploads + invoice_uploads
+        upload_times = [future.result() for _, future in uploads]
+        print_upload_summary(
+            [name for name, _ in uploads],
+            upload_times,
+            time.perf_counter() - upload_start,
+        )
 
-    export_billables(credited_projects, args.output_file)
-    export_pi_billables(credited_projects, args.output_folder, invoice_month)
-    export_BU_only(billable_projects, args.BU_invoice_file, args.BU_subsidy_amount)
-    export_HU_BU(credited_projects, args.HU_BU_invoice_file)
+    stages = [
+        Stage("merge_csv", merge_invoices, (), ("merged_invoices",)),
+        Stage("load_alias", fetch_alias, (), ("alias_dict",)),
+        Stage("fetch_old_pi_file", fetch_old_pi_file, (), ("old_pi_file",)),
+        Stage("load_exclusion_rules", load_exclusion_rules, (), ("exclusion_rules",)),
+        Stage("load_institute_map", get_institute_domain_index),
+        Stage(
+            "validate_pi_aliases",
+            validate_pi_aliases,
+            ("merged_invoices", "alias_dict"),
+            ("aliased_invoices",),
+        ),
+        Stage(
+            "add_institution",
+            add_institution,
+            ("aliased_invoices",),
+            ("invoices",),
+            after=("load_institute_map",),
+        ),
+        Stage(
+            "export_lenovo",
+            lambda dataframe: export_lenovo(
+                dataframe, args.Lenovo_file, args.csv_writer, output_buffers
+            ),
+            ("invoices",),
+        ),
+        Stage(
+            "partition_billables",
+            partition,
+            ("invoices", "exclusion_rules"),
+            ("unvalidated_billables", "nonbillable_projects"),
+        ),
+        Stage(
+            "export_nonbillables",
+            lambda dataframe: export_nonbillables(
+                dataframe, args.nonbillable_file, args.csv_writer, output_buffers
+            ),
+            ("nonbillable_projects",),
+        ),
+        Stage(
+            "validate_pi_names",
+            validate_pi_names,
+            ("unvalidated_billables",),
+            ("billable_projects",),
+        ),
+        # The credits are applied in place, so they are part of the BU invoice
+        Stage(
+            "apply_credits_new_pi",
+            apply_credits_new_pi,
+            ("billable_projects", "old_pi_file"),
+            ("credited_projects",),
+            after=("backup_old_pi_file",) if args.upload_to_s3 else (),
+        ),
+        Stage(
+            "export_invoices",
+            lambda dataframe: export_invoices(
+                dataframe,
+                args.output_file,
+                args.HU_BU_invoice_file,
+                args.output_folder,
+                invoice_month,
+                args.jobs,
+                args.csv_writer,
+                output_buffers,
+            ),
+            ("credited_projects",),
+        ),
+        Stage(
+            "export_BU_only",
+            lambda dataframe: export_BU_only(
+                dataframe,
+                args.BU_invoice_file,
+                args.BU_subsidy_amount,
+                args.csv_writer,
+            ),
+            ("credited_projects",),
+        ),
+    ]
 
+    # Streamed invoices aren't cached, so only the other downloads fill the cache
+    fetch_invoices = args.fetch_from_s3 and not args.s3_stream_inputs
+    if s3_cache_dir is not None and (
+        fetch_invoices or not (args.old_pi_file and args.alias_file)
+    ):
+        stages.append(
+            Stage(
+                "evict_s3_cache",
+                lambda: evict_cache(s3_cache_dir, args.s3_cache_max_size, ".s3"),
+                after=("merge_csv", "load_alias", "fetch_old_pi_file"),
+            )
+        )
     if args.upload_to_s3:
-        invoice_list = [
-            args.nonbillable_file,
-            args.output_file,
-            args.Lenovo_file,
+        stages += [
+            Stage(
+                "backup_old_pi_file",
+                lambda old_pi_file, dataframe: backup_to_s3_old_pi_file(
+                    old_pi_file, dataframe[PI_FIELD].unique(), invoice_month
+                ),
+                ("old_pi_file", "billable_projects"),
+            ),
+            Stage(
+                "start_uploads",
+                start_uploads,
+                ("old_pi_file",),
+                ("started_uploads", "upload_start"),
+                after=("apply_credits_new_pi", "export_lenovo", "export_nonbillables"),
+            ),
+            Stage(
+                "upload_invoices",
+                upload_invoices,
+                outputs=("invoice_uploads",),
+                after=("export_invoices",),
+            ),
+            Stage(
+                "finish_uploads",
+                finish_uploads,
+                ("started_uploads", "invoice_uploads", "upload_start"),
+            ),
         ]
+    return stages
 
-        for pi_invoice in os.listdir(args.output_folder):
-            invoice_list.append(os.path.join(args.output_folder, pi_invoice))
 
-        upload_to_s3(invoice_list, invoice_month)
-        upload_to_s3_HU_BU(args.HU_BU_invoice_file, invoice_month)
-        upload_to_s3_old_pi_file(old_pi_file)
+def fetch_s3_invoices(invoice_month, cache_dir=None):
+    """Fetches usage invoices from S3 given invoice month"""
+    return download_s3_files(list_s3_invoices(invoice_month), cache_dir=cache_dir)
 
 
-def fetch_s3_invoices(invoice_month):
-    """Fetches usage invoices from S3 given invoice month"""
-    s3_invoice_list = list()
+def open_s3_invoices(invoice_month):
+    """Returns the body stream of every usage invoice of `invoice_month` in S3
+
+    The streams can be passed to `merge_csv` in place of local files, which then
+    parses each invoice as it is downloaded, without writing it to disk."""
     invoice_bucket = get_invoice_bucket()
-    for obj in invoice_bucket.objects.filter(
-        Prefix=f"Invoices/{invoice_month}/Service Invoices/"
-    ):
-        local_name = obj.key.split("/")[-1]
-        s3_invoice_list.append(local_name)
-        invoice_bucket.download_file(obj.key, local_name)
+    return [
+        _retry_s3_request(invoice_bucket.Object(key).get)["Body"]
+        for key, _ in list_s3_invoices(invoice_month)
+    ]
+
+
+def list_s3_invoices(invoice_month):
+    """Returns the `(key, local_name)` of every usage invoice of `invoice_month` in S3"""
+    invoice_bucket = get_invoice_bucket()
+    return [
+        (obj.key, obj.key.split("/")[-1])
+        for obj in invoice_bucket.objects.filter(
+            Prefix=f"Invoices/{invoice_month}/Service Invoices/"
+        )
+    ]
+
 
-    return s3_invoice_list
+def merge_csv(files, batch_size=None, jobs=1):
+    """Merge multiple CSV files and return a single pandas dataframe
 
+    If `batch_size` is given, the files are instead streamed through pyarrow's
+    CSV reader `batch_size` bytes at a time, and the record batches are
+    assembled into the merged dataframe without the intermediate per-file
+    dataframes and the copy made by `pandas.concat`.
+
+    If `jobs` is greater than 1, the files are parsed concurrently by that many
+    threads (pyarrow's parser releases the GIL). The rows of the merged
+    dataframe are always in the order of `files`.
+    """
+    if batch_size or jobs > 1:
+        return _merge_csv_arrow(files, batch_size, jobs)
 
-def merge_csv(files):
-    """Merge multiple CSV files and return a single pandas dataframe"""
     dataframes = []
     for file in files:
-        dataframe = pandas.read_csv(
-            file, dtype={COST_FIELD: pandas.ArrowDtype(pyarrow.decimal128(12, 2))}
-        )
+        dataframe = pandas.read_csv(file, dtype=_get_parsed_dtypes())
         dataframes.append(dataframe)
 
     merged_dataframe = pandas.concat(dataframes, ignore_index=True)
     merged_dataframe.reset_index(drop=True, inplace=True)
+    # Categoricals with different categories are concatenated as objects
+    return apply_invoice_dtypes(merged_dataframe)
+
+
+def merge_csv_as_fetched(file_futures, batch_size=None):
+    """Merges the CSV files named by `file_futures` as `merge_csv` would
+
+    Each file is parsed as soon as its future is done, while the others are
+    still being fetched. The rows of the merged dataframe are in the order of
+    `file_futures`."""
+    tables = [None] * len(file_futures)
+    positions = {future: i for i, future in enumerate(file_futures)}
+    for future in concurrent.futures.as_completed(file_futures):
+        tables[positions[future]] = _read_csv_table(future.result(), batch_size)
+    merged_table = pyarrow.concat_tables(tables, promote_options="permissive")
+    del tables
+
+    return _table_to_dataframe(merged_table)
+
+
+def _read_csv_table(file, batch_size) -> pyarrow.Table:
+    """Reads a CSV file into a pyarrow table, one record batch at a time"""
+    reader = pyarrow.csv.open_csv(
+        file,
+        read_options=pyarrow.csv.ReadOptions(block_size=batch_size),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={
+                **{
+                    field: _get_arrow_type(dtype)
+                    for field, dtype in _get_parsed_dtypes().items()
+                    if dtype != "object"
+                },
+                # Read as text, to be parsed as integers once they all are
+                **{field: pyarrow.string() for field in INVOICE_INTEGER_DTYPES},
+            },
+            strings_can_be_null=True,
+        ),
+    )
+    return pyarrow.Table.from_batches(reader, schema=reader.schema)
+
+
+def _merge_csv_arrow(files, batch_size, jobs):
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            # `map` yields results in the order of `files`
+            tables = list(
+                executor.map(lambda file: _read_csv_table(file, batch_size), files)
+            )
+    else:
+        tables = [_read_csv_table(file, batch_size) for file in files]
+    # Concatenating tables only chains their record batches, nothing is copied
+    merged_table = pyarrow.concat_tables(tables, promote_options="permissive")
+    del tables
+
+    return _table_to_dataframe(merged_table)
+
+
+def _get_parsed_dtypes():
+    """Returns the types the invoice fields are parsed as, leaving the fields of
+    `INVOICE_INTEGER_DTYPES` to be inferred"""
+    return {
+        field: dtype
+        for field, dtype in INVOICE_DTYPES.items()
+        if field not in INVOICE_INTEGER_DTYPES
+    }
+
+
+def _get_invoice_dtype(field, dtype, has_nulls):
+    """Returns the type invoice field `field` is cast to from `dtype`"""
+    if (
+        field in INVOICE_INTEGER_DTYPES
+        and pandas.api.types.is_integer_dtype(dtype)
+        and not has_nulls
+    ):
+        return INVOICE_INTEGER_DTYPES[field]
+    return INVOICE_DTYPES[field]
+
+
+def _get_arrow_type(dtype):
+    if dtype == "category":
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return dtype.pyarrow_dtype
+
+
+def _table_to_dataframe(table: pyarrow.Table) -> pandas.DataFrame:
+    """Converts an Arrow table of invoices to a dataframe
+
+    Columns with an Arrow-backed type in `INVOICE_DTYPES` share the table's
+    buffers instead of being copied. Other columns get the types
+    `pandas.read_csv` would have inferred for them.
+    """
+    columns = {}
+    for field in table.schema:
+        column = table.column(field.name)
+        dtype = None
+        if field.name in INVOICE_INTEGER_DTYPES and pyarrow.types.is_string(field.type):
+            column = _parse_numbers(column)
+        if field.name in INVOICE_DTYPES:
+            dtype = _get_invoice_dtype(
+                field.name, pandas.ArrowDtype(column.type), column.null_count > 0
+            )
+        if isinstance(dtype, pandas.ArrowDtype):
+            columns[field.name] = pandas.arrays.ArrowExtensionArray(
+                column.cast(dtype.pyarrow_dtype)
+            )
+            continue
+
+        if pyarrow.types.is_null(field.type):
+            column = column.cast(pyarrow.float64())
+        elif pyarrow.types.is_date(field.type):
+            column = column.cast(pyarrow.string())
+        columns[field.name] = column.to_pandas()
+
+    return apply_invoice_dtypes(pandas.DataFrame(columns))
+
+
+def _parse_numbers(column):
+    """Parses a column of numbers read as text as integers if they all are,
+    and otherwise as floats"""
+    if column.null_count == 0:
+        try:
+            return column.cast(pyarrow.int64())
+        except pyarrow.ArrowInvalid:
+            pass
+    return column.cast(pyarrow.float64())
+
+
+def apply_invoice_dtypes(dataframe: pandas.DataFrame) -> pandas.DataFrame:
+    """Returns `dataframe` with the invoice fields it contains cast to `INVOICE_DTYPES`
+
+    Credits and subsidies that aren't Decimals yet are converted to Decimals
+    with cents."""
+    dtypes = {}
+    amounts = {}
+    for field in INVOICE_DTYPES:
+        if field not in dataframe.columns:
+            continue
+        values = dataframe[field]
+        dtype = _get_invoice_dtype(field, values.dtype, values.hasnans)
+        if dtype == "object":
+            if pandas.api.types.infer_dtype(values, skipna=True) not in (
+                "decimal",
+                "empty",
+            ):
+                amounts[field] = _to_decimal_amounts(values)
+            continue
+        if values.dtype == dtype:
+            continue
+        if (
+            isinstance(dtype, pandas.ArrowDtype)
+            and pyarrow.types.is_decimal(dtype.pyarrow_dtype)
+            and pandas.api.types.is_numeric_dtype(dataframe[field].dtype)
+            and not isinstance(dataframe[field].dtype, pandas.ArrowDtype)
+        ):
+            # Arrow can't cast int64 to a decimal narrower than 21 digits, but
+            # it can build one from Python numbers
+            dataframe = dataframe.astype({field: object})
+        dtypes[field] = dtype
+
+    if amounts:
+        dataframe = dataframe.assign(**amounts)
+    if not dtypes:
+        return dataframe
+    return dataframe.astype(dtypes)
+
+
+def _to_decimal_amounts(values: pandas.Series) -> pandas.Series:
+    if pandas.api.types.is_numeric_dtype(values.dtype) and not isinstance(
+        values.dtype, pandas.ArrowDtype
+    ):
+        values = values.astype(object)
+    amounts = pyarrow.array(
+        values.astype(pandas.ArrowDtype(pyarrow.decimal128(12, 2)))
+    ).to_pylist()
+    return pandas.Series(amounts, index=values.index, dtype=object)
+
+
+def to_cents(amounts) -> numpy.ndarray:
+    """Converts money amounts to an int64 array of cents
+
+    Decimal and integer amounts are converted exactly, and an amount with a
+    fraction of a cent is an error rather than being rounded. Float amounts
+    are rounded to the nearest cent. Missing amounts are 0 cents."""
+    amounts = pyarrow.array(amounts, from_pandas=True)
+    if pyarrow.types.is_null(amounts.type):
+        amounts = amounts.cast(pyarrow.int64())
+    if pyarrow.types.is_decimal(amounts.type):
+        amounts = pyarrow.compute.multiply(
+            amounts.cast(pyarrow.decimal128(18, 2)), CENTS_PER_DOLLAR
+        )
+    elif pyarrow.types.is_floating(amounts.type):
+        amounts = pyarrow.compute.round(
+            pyarrow.compute.multiply(amounts, CENTS_PER_DOLLAR)
+        )
+    else:
+        amounts = pyarrow.compute.multiply_checked(amounts, CENTS_PER_DOLLAR)
+    return amounts.fill_null(0).cast(pyarrow.int64()).to_numpy()
+
+
+def from_cents(cents, mask=None, dtype=INVOICE_DTYPES[BALANCE_FIELD]):
+    """Converts an array of int64 cents back to decimal money amounts of `dtype`,
+    missing where `mask` is set"""
+    cents = pyarrow.array(cents, type=pyarrow.int64(), mask=mask)
+    amounts = pyarrow.compute.multiply(
+        cents.cast(pyarrow.decimal128(19, 0)),
+        pyarrow.scalar(Decimal("0.01"), pyarrow.decimal128(3, 2)),
+    )
+    return pandas.arrays.ArrowExtensionArray(amounts.cast(dtype.pyarrow_dtype))
+
+
+def cents_to_decimal(cents) -> Decimal:
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def cents_to_decimals(cents, mask=None, whole=None) -> numpy.ndarray:
+    """Converts an array of int64 cents to an object array of Decimal amounts,
+    None where `mask` is set
+
+    The amounts where `whole` is set are whole numbers, and are kept without
+    cents, so that they are also written without them."""
+    cents = numpy.asarray(cents, dtype=numpy.int64)
+    present = numpy.ones(len(cents), dtype=bool) if mask is None else ~mask
+    whole = numpy.zeros(len(cents), dtype=bool) if whole is None else whole
+    amounts = numpy.full(len(cents), None, dtype=object)
+    amounts[present] = [
+        Decimal(int(amount_cents) // CENTS_PER_DOLLAR)
+        if is_whole
+        else cents_to_decimal(amount_cents)
+        for amount_cents, is_whole in zip(cents[present], whole[present])
+    ]
+    return amounts
+
+
+def is_whole_amount(amounts) -> numpy.ndarray:
+    """Returns a mask of the amounts that are kept without cents, i.e. integers
+    and Decimals without a fractional part, and of the missing amounts"""
+    amounts = pandas.Series(amounts)
+    if pandas.api.types.is_integer_dtype(amounts.dtype):
+        return numpy.ones(len(amounts), dtype=bool)
+    if amounts.dtype != object:
+        return amounts.isna().to_numpy()
+    return numpy.array(
+        [
+            pandas.isna(amount)
+            or isinstance(amount, (int, numpy.integer))
+            or (isinstance(amount, Decimal) and amount.as_tuple().exponent >= 0)
+            for amount in amounts
+        ],
+        dtype=bool,
+    )
+
+
+def merge_csv_cached(files, cache_dir, cache_max_size, batch_size=None, jobs=1):
+    """Returns the merged dataframe of `files`, reusing a cached copy if possible
+
+    Merged dataframes are stored in `cache_dir` as Arrow IPC files named after
+    a hash of the input files' contents and of `INVOICE_DTYPES`, so changing any
+    input file (or the dtypes) misses the cache. On a hit, the table is
+    memory-mapped instead of re-parsing the CSV files. Least recently used
+    entries are evicted once the cache grows beyond `cache_max_size` bytes.
+    """
+    cache_file = os.path.join(cache_dir, f"{get_merged_cache_key(files)}.arrow")
+
+    if os.path.exists(cache_file):
+        print(f"Loading merged invoices from cache {cache_file}")
+        os.utime(cache_file)
+        with pyarrow.memory_map(cache_file) as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        return _table_to_dataframe(table)
+
+    merged_dataframe = merge_csv(files, batch_size, jobs)
+
+    try:
+        table = pyarrow.Table.from_pandas(merged_dataframe, preserve_index=False)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as e:
+        print(f"Warning: Merged invoices could not be cached: {e}")
+        return merged_dataframe
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_cache_file = cache_file + ".tmp"
+    with pyarrow.OSFile(tmp_cache_file, "wb") as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_cache_file, cache_file)
+
+    evict_cache(cache_dir, cache_max_size, ".arrow")
     return merged_dataframe
 
 
+def get_merged_cache_key(files):
+    """Hashes the contents of `files`, in order, together with the invoice field types"""
+    key_hash = hashlib.sha256(
+        repr(
+            [sorted(INVOICE_DTYPES.items()), sorted(INVOICE_INTEGER_DTYPES.items())]
+        ).encode()
+    )
+    for file in files:
+        file_hash = hashlib.sha256()
+        with open(file, "rb") as f:
+            while chunk := f.read(1 << 20):
+                file_hash.update(chunk)
+        key_hash.update(file_hash.digest())
+
+    return key_hash.hexdigest()
+
+
+def evict_cache(cache_dir, cache_max_size, suffix):
+    """Removes least recently used cache entries, the files ending with `suffix`,
+    until the cache fits in `cache_max_size` bytes"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(suffix):
+            entry_stat = entry.stat()
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in entries)
+    # The most recently used entry is always kept
+    for _, size, path in sorted(entries)[:-1]:
+        if cache_size <= cache_max_size:
+            break
+        os.remove(path)
+        cache_size -= size
+
+
 def get_invoice_date(dataframe):
     """Returns the invoice date as a pandas timestamp object
 
@@ -365,10 +1614,9 @@ def timed_projects(timed_projects_file, invoice_date):
 
 def remove_non_billables(dataframe, pi, projects):
     """Removes projects and PIs that should not be billed from the dataframe"""
-    filtered_dataframe = dataframe[
-        ~dataframe[PI_FIELD].isin(pi) & ~dataframe[PROJECT_FIELD].isin(projects)
-    ]
-    return filtered_dataframe
+    exclusion_rules = compile_exclusion_rules(pi, projects, [])
+    billable_dataframe, _, _ = partition_billables(dataframe, exclusion_rules)
+    return billable_dataframe
 
 
 def remove_billables(dataframe, pi, projects, output_file):
@@ -376,10 +1624,69 @@ def remove_billables(dataframe, pi, projects, output_file):
 
     So this *keeps* the projects/pis that should not be billed.
     """
-    filtered_dataframe = dataframe[
-        dataframe[PI_FIELD].isin(pi) | dataframe[PROJECT_FIELD].isin(projects)
-    ]
-    filtered_dataframe.to_csv(output_file, index=False)
+    exclusion_rules = compile_exclusion_rules(pi, projects, [])
+    _, nonbillable_dataframe, _ = partition_billables(dataframe, exclusion_rules)
+    export_nonbillables(nonbillable_dataframe, output_file)
+
+
+def compile_exclusion_rules(pi, projects, timed_projects) -> dict:
+    """Returns the non-billable PIs, projects and timed projects as hashed sets
+
+    The rules are keyed by the name reported for the rows they exclude, in the
+    order they are checked.
+    """
+    return {
+        EXCLUDED_BY_PI: frozenset(pi),
+        EXCLUDED_BY_PROJECT: frozenset(projects),
+        EXCLUDED_BY_TIMED_PROJECT: frozenset(timed_projects),
+    }
+
+
+def partition_billables(dataframe, exclusion_rules):
+    """Splits the dataframe into its billable and non-billable rows
+
+    Each rule is only evaluated once per distinct PI or project, and both
+    partitions are taken from the same mask. Also returns, for every
+    non-billable row, the name of the first rule that excluded it.
+    """
+    pi_codes, pi_names = pandas.factorize(dataframe[PI_FIELD])
+    project_codes, project_names = pandas.factorize(dataframe[PROJECT_FIELD])
+    rule_masks = {
+        EXCLUDED_BY_PI: _get_exclusion_mask(
+            pi_codes, pi_names, exclusion_rules[EXCLUDED_BY_PI]
+        ),
+        EXCLUDED_BY_PROJECT: _get_exclusion_mask(
+            project_codes, project_names, exclusion_rules[EXCLUDED_BY_PROJECT]
+        ),
+        EXCLUDED_BY_TIMED_PROJECT: _get_exclusion_mask(
+            project_codes, project_names, exclusion_rules[EXCLUDED_BY_TIMED_PROJECT]
+        ),
+    }
+
+    nonbillable_mask = numpy.logical_or.reduce(list(rule_masks.values()))
+    exclusion_reasons = numpy.select(
+        list(rule_masks.values()), list(rule_masks.keys()), default=""
+    )[nonbillable_mask]
+
+    return (
+        dataframe[~nonbillable_mask],
+        dataframe[nonbillable_mask],
+        pandas.Series(exclusion_reasons, index=dataframe.index[nonbillable_mask]),
+    )
+
+
+def _get_exclusion_mask(codes, names, excluded_names):
+    excluded_codes = numpy.array([name in excluded_names for name in names], dtype=bool)
+    # Missing values have code -1, which picks the appended False
+    return numpy.append(excluded_codes, False)[codes]
+
+
+def export_nonbillables(
+    dataframe, output_file, writer=CSV_WRITERS[0], output_buffers=None
+):
+    write_output(
+        apply_invoice_dtypes(dataframe), output_file, False, writer, output_buffers
+    )
 
 
 def validate_pi_names(dataframe):
@@ -392,17 +1699,100 @@ def validate_pi_names(dataframe):
 
 
 def validate_pi_aliases(dataframe: pandas.DataFrame, alias_dict: dict):
-    for pi, pi_aliases in alias_dict.items():
-        dataframe.loc[dataframe[PI_FIELD].isin(pi_aliases), PI_FIELD] = pi
+    alias_index = build_alias_index(alias_dict)
+
+    # Look up each distinct PI once, then rewrite the rows through their codes
+    pi_codes, pi_names = pandas.factorize(dataframe[PI_FIELD])
+    canonical_names = pandas.Series(pi_names, dtype="object").map(alias_index)
+    alias_mask = numpy.isin(pi_codes, numpy.flatnonzero(canonical_names.notna()))
+    dataframe.loc[alias_mask, PI_FIELD] = canonical_names.to_numpy()[
+        pi_codes[alias_mask]
+    ]
 
     return dataframe
 
 
-def fetch_s3_alias_file():
-    local_name = "alias.csv"
-    invoice_bucket = get_invoice_bucket()
-    invoice_bucket.download_file(ALIAS_S3_FILEPATH, local_name)
-    return local_name
+def build_alias_index(alias_dict: dict) -> dict:
+    """Returns a mapping of every PI alias to its canonical PI name
+
+    If an alias is claimed by more than one PI, the first claim is kept. If an
+    alias maps to a PI which is itself an alias, it is resolved to the end of
+    that chain. Both cases are reported with a warning.
+    """
+    alias_index = {}
+    for pi, pi_aliases in alias_dict.items():
+        for alias in pi_aliases:
+            if alias == pi:
+                continue
+            claimed_pi = alias_index.setdefault(alias, pi)
+            if claimed_pi != pi:
+                print(
+                    f"Warning: Alias {alias} of PI {pi} is already an alias of PI {claimed_pi}"
+                )
+
+    for alias, pi in alias_index.items():
+        chain = [alias, pi]
+        while chain[-1] in alias_index and chain[-1] not in chain[:-1]:
+            chain.append(alias_index[chain[-1]])
+        if len(chain) > 2:
+            print(f"Warning: PI alias chain {' -> '.join(chain)}")
+            if chain[-1] in chain[:-1]:
+                print(f"Warning: Alias chain of {alias} is a cycle, mapping it to {pi}")
+            else:
+                alias_index[alias] = chain[-1]
+
+    return alias_index
+
+
+def fetch_s3_alias_file(cache_dir=None):
+    return download_s3_files(
+        [(ALIAS_S3_FILEPATH, ALIAS_LOCAL_FILE)], cache_dir=cache_dir
+    )[0]
+
+
+def _allocate_in_row_order(amounts, budgets, group_codes):
+    """Spends each group's budget on its amounts in row order
+
+    Equivalent to walking the rows of every group in order, applying
+    `min(amount, remaining)` to each until the remaining budget reaches 0.
+    Returns the applied amounts (0 where nothing is applied) and a mask of
+    the rows that had credit applied."""
+    order = numpy.argsort(group_codes, kind="stable")
+    amounts = amounts[order]
+    budgets = budgets[order]
+    group_codes = group_codes[order]
+
+    positions = numpy.arange(len(order))
+    is_group_start = numpy.ones(len(order), dtype=bool)
+    is_group_start[1:] = group_codes[1:] != group_codes[:-1]
+    group_start = numpy.maximum.accumulate(numpy.where(is_group_start, positions, 0))
+
+    def cumsum_before(values):
+        totals = numpy.cumsum(values) - values
+        return totals - totals[group_start]
+
+    amounts_before = cumsum_before(amounts)
+    exhausted = numpy.asarray(amounts_before + amounts >= budgets, dtype=bool)
+    applied_mask = (cumsum_before(exhausted.astype(numpy.int64)) == 0) & numpy.asarray(
+        budgets != 0, dtype=bool
+    )
+    applied = numpy.where(
+        applied_mask, numpy.minimum(amounts, budgets - amounts_before), 0
+    )
+
+    unsorted_applied = numpy.empty_like(applied)
+    unsorted_applied[order] = applied
+    unsorted_mask = numpy.empty_like(applied_mask)
+    unsorted_mask[order] = applied_mask
+    return unsorted_applied, unsorted_mask
+
+
+def _get_whole_allocations(amounts, budgets, group_codes, applied_mask):
+    """Returns a mask of the allocations of `_allocate_in_row_order` that spent
+    a group's whole budget on its first row, which costs more than the budget"""
+    is_first = numpy.zeros(len(group_codes), dtype=bool)
+    is_first[numpy.unique(group_codes, return_index=True)[1]] = True
+    return applied_mask & is_first & (amounts > budgets)
 
 
 def apply_credits_new_pi(dataframe, old_pi_file):
@@ -410,14 +1800,10 @@ def apply_credits_new_pi(dataframe, old_pi_file):
     INITIAL_CREDIT_AMOUNT = 1000
     EXCLUDE_SU_TYPES = ["OpenShift GPUA100SXM4", "OpenStack GPUA100SXM4"]
 
-    dataframe[CREDIT_FIELD] = None
-    dataframe[CREDIT_CODE_FIELD] = None
-    dataframe[BALANCE_FIELD] = Decimal(0)
-
-    old_pi_df = load_old_pis(old_pi_file)
-
-    current_pi_set = set(dataframe[PI_FIELD])
     invoice_month = dataframe[INVOICE_DATE_FIELD].iat[0]
+    current_pis = dataframe[PI_FIELD].unique()
+    old_pi_df = load_old_pis(old_pi_file, current_pis, invoice_month)
+
     invoice_pis = old_pi_df[old_pi_df[PI_FIRST_MONTH] == invoice_month]
     if invoice_pis[PI_INITIAL_CREDITS].empty or pandas.isna(
         new_pi_credit_amount := invoice_pis[PI_INITIAL_CREDITS].iat[0]
@@ -425,82 +1811,155 @@ def apply_credits_new_pi(dataframe, old_pi_file):
         new_pi_credit_amount = INITIAL_CREDIT_AMOUNT
 
     print(f"New PI Credit set at {new_pi_credit_amount} for {invoice_month}")
+    new_pi_credit_cents = to_cents([new_pi_credit_amount])[0]
+
+    # Work out the remaining credit of every PI still eligible this month,
+    # once per PI rather than once per row
+    pi_ages = get_pi_ages(old_pi_df, current_pis, invoice_month)
+    ledger_cents = pandas.DataFrame(
+        {field: to_cents(old_pi_df[field]) for field in PI_LEDGER_DTYPES},
+        index=old_pi_df.index,
+    )
+    pi_entries = ledger_cents[~ledger_cents.index.duplicated()].to_dict("index")
+
+    new_pis = []
+    pi_credits = {}
+    pi_credit_used_fields = {}
+    for pi, pi_age in zip(current_pis, pi_ages):
+        if pi_age == 0:
+            if pi not in pi_entries:
+                new_pis.append(pi)
+            pi_credits[pi] = new_pi_credit_cents
+            pi_credit_used_fields[pi] = PI_1ST_USED
+        elif pi_age == 1:
+            pi_entry = pi_entries[pi]
+            pi_credits[pi] = pi_entry[PI_INITIAL_CREDITS] - pi_entry[PI_1ST_USED]
+            pi_credit_used_fields[pi] = PI_2ND_USED
+
+    costs = to_cents(dataframe[COST_FIELD])
+    credits = numpy.zeros(len(dataframe), dtype=numpy.int64)
+    has_credit = numpy.zeros(len(dataframe), dtype=bool)
+
+    eligible = numpy.flatnonzero(
+        dataframe[PI_FIELD].isin(pi_credits.keys()).to_numpy()
+        & ~dataframe[SU_TYPE_FIELD].isin(EXCLUDE_SU_TYPES).to_numpy()
+    )
+    pi_codes, pi_names = pandas.factorize(dataframe[PI_FIELD].iloc[eligible])
+    pi_budgets = numpy.array([pi_credits[pi] for pi in pi_names], dtype=numpy.int64)
+    applied, applied_mask = _allocate_in_row_order(
+        costs[eligible], pi_budgets[pi_codes], pi_codes
+    )
+    credits[eligible] = applied
+    has_credit[eligible[applied_mask]] = True
+
+    # A credit is a whole amount if it is the whole of a whole number budget,
+    # i.e. the default credit, spent on a PI's first project costing more
+    whole_credits = numpy.zeros(len(dataframe), dtype=bool)
+    if isinstance(new_pi_credit_amount, int):
+        whole_budgets = numpy.array(
+            [pi_credit_used_fields[pi] == PI_1ST_USED for pi in pi_names], dtype=bool
+        )
+        whole_credits[eligible] = (
+            _get_whole_allocations(
+                costs[eligible], pi_budgets[pi_codes], pi_codes, applied_mask
+            )
+            & whole_budgets[pi_codes]
+        )
 
-    for pi in current_pi_set:
-        pi_projects = dataframe[dataframe[PI_FIELD] == pi]
-        pi_age = get_pi_age(old_pi_df, pi, invoice_month)
-        pi_old_pi_entry = old_pi_df.loc[old_pi_df[PI_PI_FIELD] == pi].squeeze()
+    dataframe[CREDIT_FIELD] = cents_to_decimals(
+        credits, mask=~has_credit, whole=whole_credits
+    )
+    dataframe[CREDIT_CODE_FIELD] = numpy.where(has_credit, new_pi_credit_code, None)
+    dataframe[BALANCE_FIELD] = from_cents(costs - credits)
 
-        if pi_age > 1:
-            for i, row in pi_projects.iterrows():
-                dataframe.at[i, BALANCE_FIELD] = row[COST_FIELD]
-        else:
-            if pi_age == 0:
-                if len(pi_old_pi_entry) == 0:
-                    pi_entry = [pi, invoice_month, new_pi_credit_amount, 0, 0]
-                    old_pi_df = pandas.concat(
-                        [
-                            pandas.DataFrame([pi_entry], columns=old_pi_df.columns),
-                            old_pi_df,
-                        ],
-                        ignore_index=True,
-                    )
-                    pi_old_pi_entry = old_pi_df.loc[
-                        old_pi_df[PI_PI_FIELD] == pi
-                    ].squeeze()
-
-                remaining_credit = new_pi_credit_amount
-                credit_used_field = PI_1ST_USED
-            elif pi_age == 1:
-                remaining_credit = (
-                    pi_old_pi_entry[PI_INITIAL_CREDITS] - pi_old_pi_entry[PI_1ST_USED]
-                )
-                credit_used_field = PI_2ND_USED
+    pi_credits_used = numpy.zeros(len(pi_names), dtype=numpy.int64)
+    numpy.add.at(pi_credits_used, pi_codes, applied)
+    pi_credits_used = dict(zip(pi_names, pi_credits_used))
 
-            initial_credit = remaining_credit
-            for i, row in pi_projects.iterrows():
-                if remaining_credit == 0 or row[SU_TYPE_FIELD] in EXCLUDE_SU_TYPES:
-                    dataframe.at[i, BALANCE_FIELD] = row[COST_FIELD]
-                else:
-                    project_cost = row[COST_FIELD]
-                    applied_credit = min(project_cost, remaining_credit)
-
-                    dataframe.at[i, CREDIT_FIELD] = applied_credit
-                    dataframe.at[i, CREDIT_CODE_FIELD] = new_pi_credit_code
-                    dataframe.at[i, BALANCE_FIELD] = row[COST_FIELD] - applied_credit
-                    remaining_credit -= applied_credit
+    new_pi_df = pandas.DataFrame(
+        {
+            PI_FIRST_MONTH: invoice_month,
+            PI_INITIAL_CREDITS: from_cents(
+                [new_pi_credit_cents] * len(new_pis),
+                dtype=PI_LEDGER_DTYPES[PI_INITIAL_CREDITS],
+            ),
+            PI_1ST_USED: 0,
+            PI_2ND_USED: 0,
+        },
+        index=pandas.Index(new_pis, name=PI_PI_FIELD, dtype="object"),
+    )
 
-            credits_used = initial_credit - remaining_credit
-            if (pi_old_pi_entry[credit_used_field] != 0) and (
-                credits_used != pi_old_pi_entry[credit_used_field]
-            ):
-                print(
-                    f"Warning: PI file overwritten. PI {pi} previously used ${pi_old_pi_entry[credit_used_field]} of New PI credits, now uses ${credits_used}"
-                )
-            old_pi_df.loc[
-                old_pi_df[PI_PI_FIELD] == pi, credit_used_field
-            ] = credits_used
+    # Only the used credits that differ from the ledger need to be written back
+    changed_credits_used = {PI_1ST_USED: {}, PI_2ND_USED: {}}
+    for pi, credit_used_field in pi_credit_used_fields.items():
+        credits_used = pi_credits_used.get(pi, 0)
+        previously_used = pi_entries.get(pi, {}).get(credit_used_field, 0)
+        if (previously_used != 0) and (credits_used != previously_used):
+            print(
+                f"Warning: PI file overwritten. PI {pi} previously used ${cents_to_decimal(previously_used)} of New PI credits, now uses ${cents_to_decimal(credits_used)}"
+            )
+        if credits_used != previously_used:
+            changed_credits_used[credit_used_field][pi] = credits_used
 
-    dump_old_pis(old_pi_file, old_pi_df)
+    update_old_pis(
+        old_pi_file,
+        old_pi_df,
+        new_pi_df,
+        {
+            credit_used_field: pandas.Series(
+                from_cents(
+                    list(pi_credits_used.values()),
+                    dtype=PI_LEDGER_DTYPES[credit_used_field],
+                ),
+                index=list(pi_credits_used),
+            )
+            for credit_used_field, pi_credits_used in changed_credits_used.items()
+        },
+    )
 
     return dataframe
 
 
-def fetch_s3_old_pi_file():
-    local_name = "PI.csv"
-    invoice_bucket = get_invoice_bucket()
-    invoice_bucket.download_file(PI_S3_FILEPATH, local_name)
-    return local_name
+def get_pi_s3_filepath(old_pi_file):
+    if is_pi_ledger_db(old_pi_file):
+        return PI_DB_S3_FILEPATH
+    return PI_S3_FILEPATH
+
+
+def fetch_s3_old_pi_file(ledger_format="csv", cache_dir=None):
+    return download_s3_files(
+        [get_old_pi_s3_download(ledger_format)], cache_dir=cache_dir
+    )[0]
+
+
+def get_old_pi_s3_download(ledger_format="csv"):
+    """Returns the S3 key and local name of the PI ledger in `ledger_format`"""
+    local_name = "PI.db" if ledger_format == "sqlite" else "PI.csv"
+    return get_pi_s3_filepath(local_name), local_name
 
 
 def upload_to_s3_old_pi_file(old_pi_file):
-    invoice_bucket = get_invoice_bucket()
-    invoice_bucket.upload_file(old_pi_file, PI_S3_FILEPATH)
+    upload_s3_files([get_old_pi_upload(old_pi_file)])
 
 
-def backup_to_s3_old_pi_file(old_pi_file):
-    invoice_bucket = get_invoice_bucket()
-    invoice_bucket.upload_file(old_pi_file, f"PIs/Archive/PI {get_iso8601_time()}.csv")
+def get_old_pi_upload(old_pi_file):
+    """Returns the `upload_s3_files` entry of the PI ledger"""
+    return old_pi_file, get_pi_s3_filepath(old_pi_file), None
+
+
+def backup_to_s3_old_pi_file(old_pi_file, pis=None, invoice_month=None):
+    """Archives the PI ledger before this month's credits are applied
+
+    An SQLite ledger is archived as a csv delta, holding only the entries this
+    month's invoice can change, i.e those of `pis` and of PIs first billed in
+    `invoice_month`. A csv ledger is archived in full."""
+    if is_pi_ledger_db(old_pi_file):
+        delta_file = f"{old_pi_file}.delta.csv"
+        dump_old_pis(delta_file, load_old_pis(old_pi_file, pis, invoice_month))
+        upload = (delta_file, f"PIs/Archive/PI {get_iso8601_time()} delta.csv", None)
+    else:
+        upload = (old_pi_file, f"PIs/Archive/PI {get_iso8601_time()}.csv", None)
+    upload_s3_files([upload])
 
 
 def add_institution(dataframe: pandas.DataFrame):
@@ -509,112 +1968,505 @@ def add_institution(dataframe: pandas.DataFrame):
     a list of known institution email domains (i.e bu.edu), or to several edge cases (i.e rudolph) if
     the username is not an email address.
 
-    Exact matches are then mapped to the corresponding institution name.
+    Email domains are matched by their longest known suffix, and then mapped to the corresponding
+    institution name.
 
-    I.e "foo@bu.edu" would match with "bu.edu", which maps to the instition name "Boston University"
+    I.e "foo@cs.bu.edu" would match with "bu.edu", which maps to the instition name "Boston University"
 
     The list of mappings are defined in `institute_map.json`.
+
+    Each distinct PI is only resolved once, and the results are mapped back onto
+    the rows in a single operation.
     """
-    institute_map = load_institute_map()
-    dataframe = dataframe.astype({INSTITUTION_FIELD: "str"})
-    for i, row in dataframe.iterrows():
-        pi_name = row[PI_FIELD]
-        if pandas.isna(pi_name):
-            print(f"Project {row[PROJECT_FIELD]} has no PI")
+    institutions = pandas.Series(
+        get_institutions_from_pis(dataframe[PI_FIELD]), index=dataframe.index
+    )
+    no_pi_mask = pandas.isna(dataframe[PI_FIELD])
+    for project in dataframe.loc[no_pi_mask, PROJECT_FIELD]:
+        print(f"Project {project} has no PI")
+
+    if no_pi_mask.any():
+        institutions = institutions.astype("str").where(
+            ~no_pi_mask, dataframe[INSTITUTION_FIELD].astype("str")
+        )
+    dataframe = dataframe.assign(**{INSTITUTION_FIELD: institutions})
+
+    return apply_invoice_dtypes(dataframe)
+
+
+def export_invoices(
+    dataframe,
+    output_file,
+    HU_BU_invoice_file,
+    output_folder,
+    invoice_month,
+    jobs=1,
+    writer=CSV_WRITERS[0],
+    output_buffers=None,
+):
+    """Writes the billable invoice, the HU and BU invoice, and every PI's invoice
+
+    These all share the same columns, so every row is formatted as csv once, and
+    each invoice is put together from the lines of the rows it selects instead of
+    filtering and formatting the dataframe again. The PI invoices are written in
+    the output format of `output_file`, and all of them are kept in
+    `output_buffers` if given, as by `open_output_stream`."""
+    dataframe = apply_invoice_dtypes(dataframe)
+    output_format = get_output_format(output_file)
+    lines = None
+    if output_format != "parquet":
+        lines = format_csv_rows(dataframe, writer)
+    export_billables(dataframe, output_file, lines, writer, output_buffers)
+    export_HU_BU(dataframe, HU_BU_invoice_file, lines, writer, output_buffers)
+    export_pi_billables(
+        dataframe,
+        output_folder,
+        invoice_month,
+        jobs,
+        lines=lines,
+        writer=writer,
+        output_format=output_format,
+        output_buffers=output_buffers,
+    )
+
+
+def format_csv_rows(dataframe: pandas.DataFrame, writer=CSV_WRITERS[0]):
+    """Returns every row of `dataframe` as a line of csv, without the index
+
+    The "arrow" writer formats the columns with pyarrow compute functions, and
+    falls back to `DataFrame.to_csv` for columns it doesn't know how to format.
+    Returns None if `DataFrame.to_csv` is used and some value spans several
+    lines, as the text then can't be split into rows."""
+    if writer == "arrow":
+        lines = _format_csv_rows_arrow(dataframe)
+        if lines is not None:
+            return lines
+    lines = dataframe.to_csv(header=False, index=False).split(os.linesep)
+    if len(lines) != len(dataframe) + 1:
+        return None
+    return numpy.array(lines[:-1], dtype=object)
+
+
+def _format_csv_rows_arrow(dataframe: pandas.DataFrame):
+    # A row of a single empty value is written as "" by `DataFrame.to_csv`
+    if len(dataframe.columns) < 2:
+        return None
+    try:
+        table = pyarrow.Table.from_pandas(dataframe, preserve_index=False)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return None
+
+    columns = []
+    for position, column in enumerate(table.columns):
+        values = dataframe.iloc[:, position]
+        if values.dtype == object and pyarrow.types.is_decimal(column.type):
+            column = _format_decimal_objects(values)
         else:
-            dataframe.at[i, INSTITUTION_FIELD] = get_institution_from_pi(
-                institute_map, pi_name
+            column = _format_csv_values(column.combine_chunks())
+        if column is None:
+            return None
+        columns.append(column)
+    lines = pyarrow.compute.binary_join_element_wise(
+        *columns, ",", null_handling="replace", null_replacement=""
+    )
+    return lines.to_numpy(zero_copy_only=False)
+
+
+def _format_csv_values(values: pyarrow.Array):
+    """Formats `values` the way `DataFrame.to_csv` does, with nulls for empty
+    values, or returns None if they are of some other type"""
+    value_type = values.type
+    if pyarrow.types.is_dictionary(value_type):
+        text = _format_csv_values(values.dictionary)
+        return None if text is None else text.take(values.indices)
+    if pyarrow.types.is_floating(value_type):
+        # Floats are written as their repr, which pyarrow doesn't produce, so
+        # only the distinct values are formatted, by numpy
+        encoded = values.dictionary_encode()
+        if len(encoded.dictionary) < len(values):
+            return _format_csv_values(encoded)
+        text = pyarrow.array(values.to_numpy(zero_copy_only=False).astype("str"))
+        return pyarrow.compute.if_else(pyarrow.compute.is_nan(values), None, text)
+    if pyarrow.types.is_boolean(value_type):
+        return pyarrow.compute.if_else(values, "True", "False")
+    if pyarrow.types.is_string(value_type) or pyarrow.types.is_large_string(value_type):
+        quoted = pyarrow.compute.binary_join_element_wise(
+            '"', pyarrow.compute.replace_substring(values, '"', '""'), '"', ""
+        )
+        return pyarrow.compute.if_else(
+            pyarrow.compute.match_substring_regex(values, CSV_QUOTE_PATTERN),
+            quoted,
+            values,
+        )
+    if (
+        pyarrow.types.is_integer(value_type)
+        or pyarrow.types.is_decimal(value_type)
+        or pyarrow.types.is_null(value_type)
+    ):
+        return values.cast(pyarrow.string())
+    return None
+
+
+def _format_decimal_objects(values: pandas.Series):
+    """Formats Python Decimals with their own number of decimal places, which
+    Arrow would make the same for all of them"""
+    present = values.notna().to_numpy()
+    text = numpy.full(len(values), None, dtype=object)
+    text[present] = [str(value) for value in values.to_numpy()[present]]
+    return pyarrow.array(text, type=pyarrow.string())
+
+
+def _to_parquet_table(dataframe: pandas.DataFrame, index=True) -> pyarrow.Table:
+    """Converts `dataframe` to an Arrow table, with its credits and subsidies
+    in the same decimal type as the other amounts"""
+    table = pyarrow.Table.from_pandas(dataframe, preserve_index=index)
+    money_type = INVOICE_DTYPES[COST_FIELD].pyarrow_dtype
+    for field in [CREDIT_FIELD, SUBSIDY_FIELD]:
+        position = table.schema.get_field_index(field)
+        if position != -1:
+            table = table.set_column(
+                position, field, table.column(position).cast(money_type)
             )
+    return table
 
-    return dataframe
 
+def _label_csv_rows(dataframe, rows, lines):
+    """Puts the index labels of the rows at positions `rows` in front of their
+    `lines` from `format_csv_rows`"""
+    labels = dataframe.index.to_numpy()[rows].astype("str").astype(object)
+    return labels + "," + lines
 
-def export_billables(dataframe, output_file):
-    dataframe.to_csv(output_file, index=False)
 
+def _join_csv_rows(lines):
+    return os.linesep.join(lines.tolist() + [""])
 
-def export_pi_billables(dataframe: pandas.DataFrame, output_folder, invoice_month):
-    if not os.path.exists(output_folder):
-        os.mkdir(output_folder)
 
-    pi_list = dataframe[PI_FIELD].unique()
+def _can_join_csv_rows(dataframe, lines, index):
+    # Integer labels are written as is, so they can be put in front of a line
+    return lines is not None and (
+        not index or pandas.api.types.is_integer_dtype(dataframe.index.dtype)
+    )
 
-    for pi in pi_list:
-        if pandas.isna(pi):
-            continue
-        pi_projects = dataframe[dataframe[PI_FIELD] == pi]
-        pi_instituition = pi_projects[INSTITUTION_FIELD].iat[0]
-        pi_projects.to_csv(
-            output_folder + f"/{pi_instituition}_{pi}_{invoice_month}.csv"
-        )
 
+def get_output_format(output_file):
+    """Returns which of the `OUTPUT_FORMATS` `output_file` is written in, from its
+    extension, or csv if it has none of theirs"""
+    return _split_output_format(output_file)[1]
 
-def export_BU_only(dataframe: pandas.DataFrame, output_file, subsidy_amount):
-    def get_project(row):
-        project_alloc = row[PROJECT_FIELD]
-        if project_alloc.rfind("-") == -1:
-            return project_alloc
-        else:
-            return project_alloc[: project_alloc.rfind("-")]
 
-    BU_projects = dataframe[dataframe[INSTITUTION_FIELD] == "Boston University"].copy()
-    BU_projects["Project"] = BU_projects.apply(get_project, axis=1)
-    BU_projects[SUBSIDY_FIELD] = Decimal(0)
-    BU_projects = BU_projects[
-        [
-            INVOICE_DATE_FIELD,
-            PI_FIELD,
-            "Project",
-            COST_FIELD,
-            CREDIT_FIELD,
-            SUBSIDY_FIELD,
-            BALANCE_FIELD,
-        ]
-    ]
+def _split_output_format(output_file):
+    for output_format in OUTPUT_FORMATS:
+        if output_file.endswith(f".{output_format}"):
+            return output_file[: -len(output_format) - 1], output_format
+    return os.path.splitext(output_file)[0], OUTPUT_FORMATS[0]
 
-    project_list = BU_projects["Project"].unique()
-    BU_projects_no_dup = BU_projects.drop_duplicates("Project", inplace=False)
-    sum_fields = [COST_FIELD, CREDIT_FIELD, BALANCE_FIELD]
-    for project in project_list:
-        project_mask = BU_projects["Project"] == project
-        no_dup_project_mask = BU_projects_no_dup["Project"] == project
 
-        sum_fields_sums = BU_projects[project_mask][sum_fields].sum().values
-        BU_projects_no_dup.loc[no_dup_project_mask, sum_fields] = sum_fields_sums
+def with_output_format(output_file, output_format):
+    """Returns `output_file` with the extension of `output_format`"""
+    if get_output_format(output_file) == output_format:
+        return output_file
+    return f"{_split_output_format(output_file)[0]}.{output_format}"
 
-    BU_projects_no_dup = _apply_subsidy(BU_projects_no_dup, subsidy_amount)
-    BU_projects_no_dup.to_csv(output_file)
 
+def open_output_stream(output_file, output_buffers=None):
+    """Opens `output_file` as a binary stream, compressed as its extension says
 
-def _apply_subsidy(dataframe, subsidy_amount):
-    pi_list = dataframe[PI_FIELD].unique()
+    If `output_buffers` is given, the file is kept in memory instead, as a
+    `pyarrow.BufferOutputStream` added to `output_buffers` under its name."""
+    sink = output_file
+    if output_buffers is not None:
+        sink = output_buffers[output_file] = pyarrow.BufferOutputStream()
+    return pyarrow.output_stream(
+        sink, compression=OUTPUT_COMPRESSION.get(get_output_format(output_file))
+    )
 
-    for pi in pi_list:
-        pi_projects = dataframe[dataframe[PI_FIELD] == pi]
-        remaining_subsidy = subsidy_amount
-        for i, row in pi_projects.iterrows():
-            project_remaining_cost = row[BALANCE_FIELD]
-            applied_subsidy = min(project_remaining_cost, remaining_subsidy)
 
-            dataframe.at[i, SUBSIDY_FIELD] = applied_subsidy
-            dataframe.at[i, BALANCE_FIELD] = row[BALANCE_FIELD] - applied_subsidy
-            remaining_subsidy -= applied_subsidy
+def open_output_file(output_file, output_buffers=None):
+    """Opens `output_file` to write text, like `open_output_stream`"""
+    if output_buffers is None and get_output_format(output_file) == "csv":
+        return open(output_file, "w", encoding="utf-8", newline="")
+    return io.TextIOWrapper(
+        open_output_stream(output_file, output_buffers),
+        encoding="utf-8",
+        newline="",
+    )
 
-            if remaining_subsidy == 0:
-                break
 
-    return dataframe
+def write_output(
+    dataframe, output_file, index=True, writer=CSV_WRITERS[0], output_buffers=None
+):
+    """Writes `dataframe` to `output_file` in the output format of its extension,
+    with csv written as `DataFrame.to_csv` would by one of the `CSV_WRITERS`"""
+    _export_rows(
+        dataframe,
+        output_file,
+        index=index,
+        writer=writer,
+        output_buffers=output_buffers,
+    )
 
 
-def export_HU_BU(dataframe, output_file):
-    HU_BU_projects = dataframe[
-        (dataframe[INSTITUTION_FIELD] == "Harvard University")
-        | (dataframe[INSTITUTION_FIELD] == "Boston University")
+def _export_rows(
+    dataframe,
+    output_file,
+    rows=None,
+    lines=None,
+    index=True,
+    writer=CSV_WRITERS[0],
+    output_buffers=None,
+):
+    """Writes the rows at positions `rows` of `dataframe`, or all its rows
+
+    The rows' csv text is taken from `lines`, from `format_csv_rows`, if
+    possible. Parquet files keep the dataframe's types."""
+    if get_output_format(output_file) == "parquet":
+        if rows is not None:
+            dataframe = dataframe.take(rows)
+        with open_output_stream(output_file, output_buffers) as f:
+            pyarrow.parquet.write_table(_to_parquet_table(dataframe, index), f)
+        return
+
+    if lines is None and writer == "arrow":
+        if rows is not None:
+            dataframe = dataframe.take(rows)
+            rows = None
+        lines = _format_csv_rows_arrow(dataframe)
+    if not _can_join_csv_rows(dataframe, lines, index):
+        if rows is not None:
+            dataframe = dataframe.take(rows)
+        with open_output_file(output_file, output_buffers) as f:
+            dataframe.to_csv(f, index=index)
+        return
+
+    if rows is None:
+        rows = numpy.arange(len(dataframe))
+    lines = lines[rows]
+    if index:
+        lines = _label_csv_rows(dataframe, rows, lines)
+    with open_output_file(output_file, output_buffers) as f:
+        f.write(dataframe.iloc[:0].to_csv(index=index))
+        f.write(_join_csv_rows(lines))
+
+
+def export_billables(
+    dataframe, output_file, lines=None, writer=CSV_WRITERS[0], output_buffers=None
+):
+    _export_rows(
+        apply_invoice_dtypes(dataframe),
+        output_file,
+        None,
+        lines,
+        False,
+        writer,
+        output_buffers,
+    )
+
+
+def export_pi_billables(
+    dataframe: pandas.DataFrame,
+    output_folder,
+    invoice_month,
+    jobs=1,
+    chunk_rows=EXPORT_CHUNK_ROWS,
+    lines=None,
+    writer=CSV_WRITERS[0],
+    output_format=OUTPUT_FORMATS[0],
+    output_buffers=None,
+):
+    """Writes each PI's rows to `{institution}_{pi}_{invoice_month}.{output_format}`
+
+    The rows are grouped by PI once, and then formatted as csv about `chunk_rows`
+    rows at a time, with each chunk's text split between its PIs. A pool of
+    `jobs` threads writes the files while the next chunk is formatted. Rows
+    already formatted by `format_csv_rows` can be passed as `lines`, or are
+    otherwise formatted with `writer`. Parquet files are sliced from an Arrow
+    table of each chunk's rows. The files are kept in `output_buffers` if given,
+    as by `open_output_stream`."""
+    if output_buffers is None and not os.path.exists(output_folder):
+        os.mkdir(output_folder)
+
+    dataframe = apply_invoice_dtypes(dataframe)
+    # Rows without a PI get code -1, and so fall before the first PI's slice
+    pi_codes, pi_list = pandas.factorize(dataframe[PI_FIELD])
+    row_order = numpy.argsort(pi_codes, kind="stable")
+    pi_bounds = numpy.searchsorted(pi_codes[row_order], numpy.arange(len(pi_list) + 1))
+
+    pi_institutions = dataframe[INSTITUTION_FIELD].iloc[row_order[pi_bounds[:-1]]]
+    pi_invoice_files = [
+        os.path.join(
+            output_folder, f"{pi_instituition}_{pi}_{invoice_month}.{output_format}"
+        )
+        for pi_instituition, pi in zip(pi_institutions.tolist(), pi_list)
     ]
-    HU_BU_projects.to_csv(output_file)
+    header = dataframe.iloc[:0].to_csv()
+    row_lines = lines
+    table = None
+    if output_format == "parquet":
+        table = _to_parquet_table(dataframe)
+
+    def write_pi_invoices(pi_invoices):
+        for pi_invoice_file, pi_invoice in pi_invoices:
+            if isinstance(pi_invoice, str):
+                with open_output_file(pi_invoice_file, output_buffers) as f:
+                    f.write(pi_invoice)
+            elif isinstance(pi_invoice, pyarrow.Table):
+                with open_output_stream(pi_invoice_file, output_buffers) as f:
+                    pyarrow.parquet.write_table(pi_invoice, f)
+            else:
+                with open_output_file(pi_invoice_file, output_buffers) as f:
+                    dataframe.take(pi_invoice).to_csv(f)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = []
+        for first_pi, last_pi in _get_chunks(pi_bounds, chunk_rows):
+            chunk_start = pi_bounds[first_pi]
+            chunk = row_order[chunk_start : pi_bounds[last_pi]]
+            if table is not None:
+                lines = None
+                chunk_table = table.take(chunk)
+            elif row_lines is None:
+                lines = format_csv_rows(dataframe.take(chunk), writer)
+            else:
+                lines = row_lines[chunk]
+            # If some values span several lines, the text can't be split by
+            # line, and each PI's rows are formatted on their own instead
+            can_split = _can_join_csv_rows(dataframe, lines, index=True)
+            if can_split:
+                lines = _label_csv_rows(dataframe, chunk, lines)
+
+            pi_invoices = []
+            for pi_code in range(first_pi, last_pi):
+                start = pi_bounds[pi_code] - chunk_start
+                end = pi_bounds[pi_code + 1] - chunk_start
+                if can_split:
+                    pi_invoice = header + _join_csv_rows(lines[start:end])
+                elif table is not None:
+                    pi_invoice = chunk_table.slice(start, end - start)
+                else:
+                    pi_invoice = chunk[start:end]
+                pi_invoices.append((pi_invoice_files[pi_code], pi_invoice))
+
+            # Each thread gets one batch of files per chunk
+            batch_size = -(-len(pi_invoices) // jobs)
+            submitted = [
+                executor.submit(write_pi_invoices, pi_invoices[i : i + batch_size])
+                for i in range(0, len(pi_invoices), batch_size)
+            ]
+
+            # Only the chunk being formatted and the one being written are kept
+            for future in pending:
+                future.result()
+            pending = submitted
+        for future in pending:
+            future.result()
+
+
+def _get_chunks(bounds, chunk_rows):
+    """Yields runs of consecutive groups, delimited by `bounds`, of about `chunk_rows` rows"""
+    first = 0
+    for last in range(1, len(bounds)):
+        if bounds[last] - bounds[first] >= chunk_rows or last == len(bounds) - 1:
+            yield first, last
+            first = last
+
+
+def export_BU_only(
+    dataframe: pandas.DataFrame, output_file, subsidy_amount, writer=CSV_WRITERS[0]
+):
+    BU_projects = dataframe[dataframe[INSTITUTION_FIELD] == "Boston University"]
+    BU_projects = BU_projects[[INVOICE_DATE_FIELD, PI_FIELD]].assign(
+        **{
+            # The project name is the allocation name up to its last "-"
+            "Project": BU_projects[PROJECT_FIELD].str.replace(
+                r"-[^-]*$", "", regex=True
+            ),
+            # Totals and subsidies are worked out in cents
+            COST_FIELD: to_cents(BU_projects[COST_FIELD]),
+            CREDIT_FIELD: to_cents(BU_projects[CREDIT_FIELD]),
+            # A project's credit total is whole if all its credits are
+            "partial_credits": ~is_whole_amount(BU_projects[CREDIT_FIELD]),
+            SUBSIDY_FIELD: 0,
+            BALANCE_FIELD: to_cents(BU_projects[BALANCE_FIELD]),
+        }
+    )
+
+    # Each project is reported on its first row, with the totals of all its rows
+    sum_fields = [COST_FIELD, CREDIT_FIELD, "partial_credits", BALANCE_FIELD]
+    BU_projects_no_dup = BU_projects.drop_duplicates("Project")
+    project_sums = BU_projects.groupby("Project", sort=False, dropna=False)[
+        sum_fields
+    ].sum()
+    BU_projects_no_dup = BU_projects_no_dup.assign(
+        **{field: project_sums[field].to_numpy() for field in sum_fields}
+    )
+
+    BU_projects_no_dup, whole_subsidies = _apply_subsidy(
+        BU_projects_no_dup,
+        to_cents([subsidy_amount])[0],
+        isinstance(subsidy_amount, int),
+    )
+    BU_projects_no_dup = BU_projects_no_dup.assign(
+        **{
+            COST_FIELD: from_cents(BU_projects_no_dup[COST_FIELD].to_numpy()),
+            CREDIT_FIELD: cents_to_decimals(
+                BU_projects_no_dup[CREDIT_FIELD].to_numpy(),
+                whole=BU_projects_no_dup["partial_credits"].to_numpy() == 0,
+            ),
+            SUBSIDY_FIELD: cents_to_decimals(
+                BU_projects_no_dup[SUBSIDY_FIELD].to_numpy(), whole=whole_subsidies
+            ),
+            BALANCE_FIELD: from_cents(BU_projects_no_dup[BALANCE_FIELD].to_numpy()),
+        }
+    ).drop(columns="partial_credits")
+    write_output(apply_invoice_dtypes(BU_projects_no_dup), output_file, writer=writer)
+
+
+def _apply_subsidy(dataframe, subsidy_amount, whole_subsidy=False):
+    """Applies up to `subsidy_amount` to each PI's project balances, in order
+
+    `subsidy_amount` and the balance and subsidy fields are in cents. Also
+    returns a mask of the subsidies that are whole amounts, those left at 0 and,
+    if `whole_subsidy` is set, those of the whole `subsidy_amount`."""
+    pi_codes, _ = pandas.factorize(dataframe[PI_FIELD])
+    balances = dataframe[BALANCE_FIELD].to_numpy()
+    budgets = numpy.full(len(balances), subsidy_amount)
+    subsidies, applied_mask = _allocate_in_row_order(balances, budgets, pi_codes)
+    whole_subsidies = ~applied_mask
+    if whole_subsidy:
+        whole_subsidies |= _get_whole_allocations(
+            balances, budgets, pi_codes, applied_mask
+        )
+    return (
+        dataframe.assign(
+            **{SUBSIDY_FIELD: subsidies, BALANCE_FIELD: balances - subsidies}
+        ),
+        whole_subsidies,
+    )
 
 
-def export_lenovo(dataframe: pandas.DataFrame, output_file):
+def export_HU_BU(
+    dataframe, output_file, lines=None, writer=CSV_WRITERS[0], output_buffers=None
+):
+    dataframe = apply_invoice_dtypes(dataframe)
+    HU_BU_rows = numpy.flatnonzero(
+        dataframe[INSTITUTION_FIELD].isin(["Harvard University", "Boston University"])
+    )
+    _export_rows(
+        dataframe,
+        output_file,
+        HU_BU_rows,
+        lines,
+        writer=writer,
+        output_buffers=output_buffers,
+    )
+
+
+def export_lenovo(
+    dataframe: pandas.DataFrame,
+    output_file,
+    writer=CSV_WRITERS[0],
+    output_buffers=None,
+):
     LENOVO_SU_TYPES = ["OpenShift GPUA100SXM4", "OpenStack GPUA100SXM4"]
     SU_CHARGE_MULTIPLIER = 1
 
@@ -631,32 +2483,99 @@ def export_lenovo(dataframe: pandas.DataFrame, output_file):
     lenovo_df.rename(columns={SU_HOURS_FIELD: "SU Hours"}, inplace=True)
     lenovo_df.insert(len(lenovo_df.columns), "SU Charge", SU_CHARGE_MULTIPLIER)
     lenovo_df["Charge"] = lenovo_df["SU Hours"] * lenovo_df["SU Charge"]
-    lenovo_df.to_csv(output_file)
+    write_output(
+        apply_invoice_dtypes(lenovo_df),
+        output_file,
+        writer=writer,
+        output_buffers=output_buffers,
+    )
 
 
-def upload_to_s3(invoice_list: list, invoice_month):
-    invoice_bucket = get_invoice_bucket()
+def get_upload_source(invoice_filename, output_buffers=None):
+    """Returns the file to upload as `invoice_filename`, or its buffer if it
+    was kept in `output_buffers`"""
+    if output_buffers is None:
+        return invoice_filename
+    return output_buffers[invoice_filename].getvalue()
+
+
+def upload_to_s3(invoice_list: list, invoice_month, output_buffers=None):
+    uploads = get_invoice_uploads(
+        invoice_list, invoice_month, get_iso8601_time(), output_buffers
+    )
+    start = time.perf_counter()
+    upload_times = upload_s3_files(uploads)
+    print_upload_summary(invoice_list, upload_times, time.perf_counter() - start)
+
+
+def get_invoice_uploads(
+    invoice_list: list, invoice_month, archive_time, output_buffers=None
+):
+    """Returns the `upload_s3_files` entries of the invoices of `invoice_list`,
+    archived under `archive_time`"""
+    uploads = []
     for invoice_filename in invoice_list:
-        striped_filename = os.path.splitext(invoice_filename)[0]
-        invoice_s3_path = (
-            f"Invoices/{invoice_month}/{striped_filename} {invoice_month}.csv"
+        striped_filename, output_format = _split_output_format(invoice_filename)
+        invoice_s3_path = f"Invoices/{invoice_month}/{striped_filename} {invoice_month}.{output_format}"
+        invoice_s3_path_archive = f"Invoices/{invoice_month}/Archive/{striped_filename} {invoice_month} {archive_time}.{output_format}"
+        uploads.append(
+            (
+                get_upload_source(invoice_filename, output_buffers),
+                invoice_s3_path,
+                invoice_s3_path_archive,
+            )
         )
-        invoice_s3_path_archive = f"Invoices/{invoice_month}/Archive/{striped_filename} {invoice_month} {get_iso8601_time()}.csv"
-        invoice_bucket.upload_file(invoice_filename, invoice_s3_path)
-        invoice_bucket.upload_file(invoice_filename, invoice_s3_path_archive)
+    return uploads
 
 
-def upload_to_s3_HU_BU(invoice_filename, invoice_month):
-    invoice_bucket = get_invoice_bucket()
-    invoice_bucket.upload_file(
-        invoice_filename,
-        f"Invoices/{invoice_month}/NERC-{invoice_month}-Total-Invoice.csv",
+def print_upload_summary(invoice_list: list, upload_times, elapsed):
+    """Prints how long the uploads of `invoice_list` took, and the slowest one"""
+    if upload_times:
+        slowest = max(range(len(upload_times)), key=upload_times.__getitem__)
+        print(
+            f"Uploaded {len(upload_times)} invoices to S3 in {elapsed:.2f}s,"
+            f" the slowest being {invoice_list[slowest]} in {upload_times[slowest]:.2f}s"
+        )
+
+
+def upload_to_s3_HU_BU(invoice_filename, invoice_month, output_buffers=None):
+    upload_s3_files(
+        [
+            get_HU_BU_upload(
+                invoice_filename, invoice_month, get_iso8601_time(), output_buffers
+            )
+        ]
     )
-    invoice_bucket.upload_file(
-        invoice_filename,
-        f"Invoices/{invoice_month}/Archive/NERC-{invoice_month}-Total-Invoice {get_iso8601_time()}.csv",
+
+
+def get_HU_BU_upload(
+    invoice_filename, invoice_month, archive_time, output_buffers=None
+):
+    """Returns the `upload_s3_files` entry of the HU and BU invoice"""
+    output_format = get_output_format(invoice_filename)
+    return (
+        get_upload_source(invoice_filename, output_buffers),
+        f"Invoices/{invoice_month}/NERC-{invoice_month}-Total-Invoice.{output_format}",
+        f"Invoices/{invoice_month}/Archive/NERC-{invoice_month}-Total-Invoice {archive_time}.{output_format}",
     )
 
 
+def list_pi_invoices(output_folder, output_buffers=None):
+    """Returns the PI invoices written to `output_folder` or to `output_buffers`"""
+    if output_buffers is None:
+        return [
+            os.path.join(output_folder, pi_invoice)
+            for pi_invoice in os.listdir(output_folder)
+        ]
+    # The buffers are named after the folder as given, e.g. "./pi_invoices/..."
+    # as are the files listed on disk
+    output_folder = os.path.normpath(output_folder)
+    return [
+        pi_invoice
+        for pi_invoice in output_buffers
+        if os.path.normpath(os.path.dirname(pi_invoice)) == output_folder
+    ]
+
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,28 @@
-from unittest import TestCase, mock
+from unittest import TestCase, mock, skipUnless
 import tempfile
+import numpy
 import pandas
 import pyarrow
+import pyarrow.parquet
+import botocore.exceptions
 import os
 import math
+import time
+import threading
+import concurrent.futures
+import json
+import pstats
+import io
 from textwrap import dedent
+from decimal import Decimal
 
 from process_report import process_report
 
+try:
+    import moto
+except ImportError:
+    moto = None
+
 
 class TestGetInvoiceDate(TestCase):
     def test_get_invoice_date(self):
@@ -127,6 +142,22 @@ class TestRemoveNonBillables(TestCase):
         self.assertNotIn("ProjectA", result_df["Project - Allocation"].tolist())
         self.assertNotIn("ProjectE", result_df["Project - Allocation"].tolist())
 
+    def test_partition_billables(self):
+        exclusion_rules = process_report.compile_exclusion_rules(
+            self.pi_to_exclude, ["ProjectB"], ["ProjectD", "ProjectC"]
+        )
+        billables_df, nonbillables_df, reasons = process_report.partition_billables(
+            self.dataframe, exclusion_rules
+        )
+
+        self.assertEqual(["PI1", "PI5"], billables_df["Manager (PI)"].tolist())
+        self.assertEqual(
+            ["PI2", "PI3", "PI4"], nonbillables_df["Manager (PI)"].tolist()
+        )
+        # PI3's ProjectC is also a timed project, but the PI list is checked first
+        self.assertEqual(["PI", "PI", "timed project"], reasons.tolist())
+        self.assertTrue(reasons.index.equals(nonbillables_df.index))
+
 
 class TestMergeCSV(TestCase):
     def setUp(self):
@@ -165,6 +196,199 @@ class TestMergeCSV(TestCase):
         # Assert that the headers in the merged DataFrame match the expected headers
         self.assertListEqual(merged_dataframe.columns.tolist(), self.header)
 
+    def test_merge_csv_streaming(self):
+        csv_files = [csv_file.name for csv_file in self.csv_files]
+        merged_dataframe = process_report.merge_csv(csv_files)
+        streamed_dataframe = process_report.merge_csv(csv_files, batch_size=32)
+
+        self.assertTrue(merged_dataframe.equals(streamed_dataframe))
+
+    def test_merge_csv_parallel(self):
+        for i, csv_file in enumerate(self.csv_files):
+            with open(csv_file.name, "a") as f:
+                f.write(f"{i + 4},File{i},40\n")
+
+        csv_files = [csv_file.name for csv_file in self.csv_files]
+        merged_dataframe = process_report.merge_csv(csv_files)
+        parallel_dataframe = process_report.merge_csv(csv_files, jobs=3)
+
+        self.assertTrue(merged_dataframe.equals(parallel_dataframe))
+        self.assertEqual(
+            ["File0", "File1", "File2"],
+            parallel_dataframe.loc[parallel_dataframe["ID"] > 3, "Name"].tolist(),
+        )
+
+    def test_merge_csv_as_fetched(self):
+        csv_files = [csv_file.name for csv_file in self.csv_files]
+        futures = [concurrent.futures.Future() for _ in csv_files]
+        # The last file is fetched first, but its rows still come last
+        for future, csv_file in reversed(list(zip(futures, csv_files))):
+            future.set_result(csv_file)
+
+        self.assertTrue(
+            process_report.merge_csv(csv_files).equals(
+                process_report.merge_csv_as_fetched(futures)
+            )
+        )
+
+    def test_merge_csv_streaming_cost(self):
+        csv_file = tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".csv")
+        csv_file.write("Manager (PI),Cost,Note\nPI1,10.50,\n,0.25,\n")
+        csv_file.close()
+        self.csv_files.append(csv_file)
+
+        merged_dataframe = process_report.merge_csv([csv_file.name])
+        streamed_dataframe = process_report.merge_csv([csv_file.name], batch_size=32)
+
+        self.assertEqual(
+            streamed_dataframe["Cost"].dtype,
+            pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+        )
+        self.assertTrue(merged_dataframe.equals(streamed_dataframe))
+
+
+class TestInvoiceDtypes(TestCase):
+    def setUp(self):
+        csv_file = tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".csv")
+        csv_file.write(
+            dedent(
+                """\
+            Invoice Month,Project - Allocation,Manager (PI),Institution,SU Hours (GBhr or SUhr),SU Type,Cost,Untyped
+            2024-03,ProjectA,PI1,,10,OpenShift CPU,10.50,1
+            2024-03,ProjectB,,,2.5,OpenStack CPU,0.25,2
+            """
+            )
+        )
+        csv_file.close()
+        self.csv_file = csv_file.name
+
+    def tearDown(self):
+        os.remove(self.csv_file)
+
+    def test_merge_csv_dtypes(self):
+        for kwargs in [{}, {"batch_size": 1 << 20}]:
+            dataframe = process_report.merge_csv([self.csv_file], **kwargs)
+            for field in dataframe.columns:
+                if field == "Untyped":
+                    self.assertEqual("int64", dataframe[field].dtype)
+                else:
+                    self.assertTrue(
+                        dataframe[field].dtype == process_report.INVOICE_DTYPES[field]
+                    )
+            self.assertTrue(pandas.isna(dataframe["Manager (PI)"][1]))
+
+    def test_su_hours_dtype(self):
+        header = "Invoice Month,SU Hours (GBhr or SUhr)\n"
+        rows = "".join(f"2024-03,{hours}\n" for hours in range(100))
+        for last_hours, dtype, last_value in [
+            ("100", pandas.ArrowDtype(pyarrow.int64()), 100),
+            ("2.5", pandas.ArrowDtype(pyarrow.float64()), 2.5),
+            ("", pandas.ArrowDtype(pyarrow.float64()), None),
+        ]:
+            with open(self.csv_file, "w") as f:
+                f.write(header + rows + f"2024-03,{last_hours}\n")
+            # The fraction is only in the last of many batches
+            for kwargs in [{}, {"batch_size": 64}, {"jobs": 2}]:
+                hours = process_report.merge_csv([self.csv_file], **kwargs)[
+                    "SU Hours (GBhr or SUhr)"
+                ]
+                self.assertEqual(dtype, hours.dtype)
+                self.assertEqual(list(range(100)), list(hours[:100]))
+                if last_value is None:
+                    self.assertTrue(pandas.isna(hours[100]))
+                else:
+                    self.assertEqual(last_value, hours[100])
+
+    def test_apply_invoice_dtypes(self):
+        dataframe = pandas.DataFrame(
+            {"Cost": [10, 20], "Credit": [None, 5], "SU Type": ["CPU", "CPU"]}
+        )
+        output = process_report.apply_invoice_dtypes(dataframe)
+
+        self.assertEqual([None, Decimal("5.00")], list(output["Credit"]))
+        self.assertEqual("category", output["SU Type"].dtype)
+        self.assertEqual("10.00", str(output["Cost"][0]))
+        # The input dataframe is left untouched
+        self.assertEqual("int64", dataframe["Cost"].dtype)
+
+
+class TestCents(TestCase):
+    def test_to_cents(self):
+        money = pandas.Series(
+            ["12.34", None, "-0.05"],
+            dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+        )
+        self.assertEqual(list(process_report.to_cents(money)), [1234, 0, -5])
+        self.assertEqual(list(process_report.to_cents([1000, -3])), [100000, -300])
+        self.assertEqual(list(process_report.to_cents([0.1, 2.5])), [10, 250])
+
+        sub_cent = pandas.Series(
+            ["1.005"], dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 3))
+        )
+        with self.assertRaises(pyarrow.ArrowInvalid):
+            process_report.to_cents(sub_cent)
+
+    def test_from_cents(self):
+        money = process_report.from_cents([1234, 0, -5], mask=[False, True, False])
+        self.assertEqual(
+            money.dtype, process_report.INVOICE_DTYPES[process_report.BALANCE_FIELD]
+        )
+        self.assertEqual([str(amount) for amount in money], ["12.34", "<NA>", "-0.05"])
+        self.assertEqual(list(process_report.to_cents(money)), [1234, 0, -5])
+
+
+class TestMergeCSVCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.csv_files = []
+        for i in range(2):
+            csv_file = tempfile.NamedTemporaryFile(
+                delete=False, mode="w", suffix=".csv"
+            )
+            csv_file.write(f"Manager (PI),Cost\nPI{i},10.50\n,0.25\n")
+            csv_file.close()
+            self.csv_files.append(csv_file.name)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+        for csv_file in self.csv_files:
+            os.remove(csv_file)
+
+    def test_cache_hit(self):
+        merged_dataframe = process_report.merge_csv_cached(
+            self.csv_files, self.cache_dir.name, 2**20
+        )
+        self.assertEqual(1, len(os.listdir(self.cache_dir.name)))
+
+        with mock.patch("process_report.process_report.merge_csv") as mock_merge:
+            cached_dataframe = process_report.merge_csv_cached(
+                self.csv_files, self.cache_dir.name, 2**20
+            )
+            mock_merge.assert_not_called()
+
+        self.assertTrue(merged_dataframe.equals(cached_dataframe))
+        self.assertEqual(merged_dataframe["Cost"].dtype, cached_dataframe["Cost"].dtype)
+
+    def test_cache_invalidated(self):
+        key = process_report.get_merged_cache_key(self.csv_files)
+        self.assertNotEqual(
+            key, process_report.get_merged_cache_key(self.csv_files[::-1])
+        )
+
+        with open(self.csv_files[0], "a") as f:
+            f.write("PI3,1.00\n")
+        self.assertNotEqual(key, process_report.get_merged_cache_key(self.csv_files))
+
+    def test_cache_eviction(self):
+        process_report.merge_csv_cached(self.csv_files[:1], self.cache_dir.name, 2**20)
+        first_entry = os.listdir(self.cache_dir.name)[0]
+        os.utime(os.path.join(self.cache_dir.name, first_entry), (0, 0))
+
+        # The newest entry is kept even if the cache is still too large
+        process_report.merge_csv_cached(self.csv_files, self.cache_dir.name, 1)
+        self.assertEqual(1, len(os.listdir(self.cache_dir.name)))
+        self.assertNotIn(first_entry, os.listdir(self.cache_dir.name))
+
 
 class TestExportPICSV(TestCase):
     def setUp(self):
@@ -221,6 +445,45 @@ class TestExportPICSV(TestCase):
         self.assertNotIn("ProjectB", pi_df["Project - Allocation"].tolist())
         self.assertNotIn("ProjectC", pi_df["Project - Allocation"].tolist())
 
+    def test_export_pi_chunks(self):
+        dataframe = self.dataframe.copy()
+        dataframe.loc[4, "Untouch Data Column"] = "Data\nE"
+        dataframe = dataframe.iloc[[0, 3, 1, 4, 2]]
+
+        for chunk_rows in [1, 2, 100]:
+            output_dir = tempfile.TemporaryDirectory()
+            process_report.export_pi_billables(
+                dataframe, output_dir.name, self.invoice_month, 2, chunk_rows
+            )
+            for pi, institution in [("PI1", "BU"), ("PI2", "HU")]:
+                with open(f"{output_dir.name}/{institution}_{pi}_2023-01.csv") as f:
+                    self.assertEqual(
+                        f.read(),
+                        dataframe[dataframe["Manager (PI)"] == pi].to_csv(),
+                    )
+
+    def test_export_invoices(self):
+        for untouched in ["DataE", "Data\nE"]:
+            dataframe = self.dataframe.copy()
+            dataframe["Institution"] = ["Boston University"] * 3 + ["MIT"] * 2
+            dataframe.loc[4, "Untouch Data Column"] = untouched
+            dataframe = process_report.apply_invoice_dtypes(dataframe)
+
+            output_dir = tempfile.TemporaryDirectory()
+            process_report.export_invoices(
+                dataframe,
+                f"{output_dir.name}/billable.csv",
+                f"{output_dir.name}/HU_BU.csv",
+                output_dir.name,
+                self.invoice_month,
+            )
+            with open(f"{output_dir.name}/billable.csv") as f:
+                self.assertEqual(f.read(), dataframe.to_csv(index=False))
+            with open(f"{output_dir.name}/HU_BU.csv") as f:
+                self.assertEqual(f.read(), dataframe.iloc[:3].to_csv())
+            with open(f"{output_dir.name}/MIT_PI2_2023-01.csv") as f:
+                self.assertEqual(f.read(), dataframe.iloc[3:].to_csv())
+
 
 class TestGetInstitute(TestCase):
     def test_get_pi_institution(self):
@@ -258,6 +521,92 @@ class TestGetInstitute(TestCase):
             "Northeastern University",
         )
 
+    def test_get_pi_institution_subdomain(self):
+        institute_map = {
+            "harvard.edu": "Harvard University",
+            "mclean.harvard.edu": "McLean Hospital",
+            "bu.edu": "Boston University",
+            "rudolph": "Boston Childrens Hospital",
+        }
+
+        self.assertEqual(
+            process_report.get_institution_from_pi(institute_map, "a@cs.BU.edu"),
+            "Boston University",
+        )
+        self.assertEqual(
+            process_report.get_institution_from_pi(
+                institute_map, "b@lab.mclean.harvard.edu"
+            ),
+            "McLean Hospital",
+        )
+        self.assertEqual(
+            process_report.get_institution_from_pi(institute_map, "rudolph"),
+            "Boston Childrens Hospital",
+        )
+        # Only email domains are matched by suffix
+        self.assertEqual(
+            process_report.get_institution_from_pi(institute_map, "x.rudolph"), ""
+        )
+        self.assertEqual(
+            process_report.get_institution_from_pi(institute_map, "c@notbu.edu"), ""
+        )
+
+    def test_get_institutions_from_pis(self):
+        institutions = process_report.get_institutions_from_pis(
+            pandas.Series(["a@cs.bu.edu", None, "rudolph", "a@cs.bu.edu", "fake"])
+        )
+
+        self.assertEqual(
+            [
+                "Boston University",
+                None,
+                "Boston Childrens Hospital",
+                "Boston University",
+                "",
+            ],
+            [None if pandas.isna(i) else i for i in institutions],
+        )
+        self.assertIs(
+            process_report.get_institute_domain_index(),
+            process_report.get_institute_domain_index(),
+        )
+
+
+class TestAddInstitution(TestCase):
+    def setUp(self):
+        self.dataframe = pandas.DataFrame(
+            {
+                "Manager (PI)": ["a@bu.edu", "b@harvard.edu", None, "a@bu.edu", "fake"],
+                "Project - Allocation": ["P1", "P2", "P3", "P4", "P5"],
+                "Institution": ["", "", "Bentley", "", ""],
+            }
+        )
+
+    def test_add_institution(self):
+        output = process_report.add_institution(self.dataframe)
+
+        self.assertEqual(
+            # Rows without a PI keep their institution
+            [
+                "Boston University",
+                "Harvard University",
+                "Bentley",
+                "Boston University",
+                "",
+            ],
+            output["Institution"].tolist(),
+        )
+        self.assertEqual(
+            ["", "", "Bentley", "", ""], self.dataframe["Institution"].tolist()
+        )
+
+    @mock.patch("process_report.process_report.get_institution_from_pi")
+    def test_resolve_each_pi_once(self, mock_get_institution):
+        mock_get_institution.return_value = "Boston University"
+        process_report.add_institution(self.dataframe)
+
+        self.assertEqual(3, mock_get_institution.call_count)
+
 
 class TestAlias(TestCase):
     def setUp(self):
@@ -279,6 +628,31 @@ class TestAlias(TestCase):
         output = process_report.validate_pi_aliases(self.data, self.alias_dict)
         self.assertTrue(self.answer.equals(output))
 
+    def test_alias_index(self):
+        alias_index = process_report.build_alias_index(
+            {
+                "PI1": ["PI1_1", "PI1_2"],
+                "PI2": ["PI2_1", "PI1_1"],  # Conflict, PI1 claimed PI1_1 first
+                "PI3": ["PI3_1"],
+                "PI3_1": ["PI3_2"],  # Chain, PI3_2 resolves to PI3
+                "PI4": ["PI5"],
+                "PI5": ["PI4"],  # Cycle
+            }
+        )
+
+        self.assertEqual(
+            {
+                "PI1_1": "PI1",
+                "PI1_2": "PI1",
+                "PI2_1": "PI2",
+                "PI3_1": "PI3",
+                "PI3_2": "PI3",
+                "PI5": "PI4",
+                "PI4": "PI5",
+            },
+            alias_index,
+        )
+
 
 class TestMonthUtils(TestCase):
     def test_get_month_diff(self):
@@ -572,6 +946,51 @@ class TestCredit0002(TestCase):
 
         self.assertTrue(old_pi_df_output.equals(self.old_pi_df_answer))
 
+    def test_apply_credit_0002_sqlite(self):
+        old_pi_db = self.old_pi_file.replace(".csv", ".db")
+        self.addCleanup(os.remove, old_pi_db)
+        process_report.convert_old_pis(self.old_pi_file, old_pi_db)
+
+        billed_pis = process_report.load_old_pis(
+            old_pi_db, ["PI1", "NewPI1"], "2024-03"
+        )
+        self.assertEqual(list(billed_pis.index), ["PI1", "PI7"])
+
+        dataframe = process_report.apply_credits_new_pi(self.dataframe, old_pi_db)
+        dataframe = dataframe.astype({"Credit": "float64", "Balance": "int64"})
+        self.assertTrue(self.answer_dataframe.equals(dataframe))
+
+        old_pi_df_output = (
+            process_report.load_old_pis(old_pi_db)
+            .reset_index()
+            .sort_values(by=["PI"], ignore_index=True)
+        )
+        self.assertTrue(old_pi_df_output.equals(self.old_pi_df_answer))
+
+    def test_convert_old_pis(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        csv_file, db_file, output_file = (
+            os.path.join(work_dir.name, name) for name in ["PI.csv", "PI.db", "out.csv"]
+        )
+        # Credits not used yet are left blank, and stored as NULL
+        with open(csv_file, "w") as f:
+            f.write(
+                "PI,First Invoice Month,Initial Credits,1st Month Used,2nd Month Used\n"
+                "PI1,2024-01,1000.00,500.00,\n"
+                "PI2,2024-02,1000.00,,\n"
+            )
+
+        for source, destination in [(csv_file, db_file), (db_file, output_file)]:
+            argv = ["process_report.py", "--convert-old-pi-file", source, destination]
+            with mock.patch("sys.argv", argv):
+                process_report.main()
+        with open(csv_file) as f, open(output_file) as output:
+            self.assertEqual(output.read(), f.read())
+
+        old_pi_df = process_report.load_old_pis(db_file)
+        self.assertEqual(old_pi_df["2nd Month Used"].isna().tolist(), [True, True])
+
     def test_no_gpu(self):
         dataframe = process_report.apply_credits_new_pi(
             self.dataframe_no_gpu, self.old_pi_no_gpu_file
@@ -582,11 +1001,196 @@ class TestCredit0002(TestCase):
     def test_apply_credit_error(self):
         old_pi_df = pandas.DataFrame(
             {"PI": ["PI1"], "First Invoice Month": ["2024-04"]}
-        )
+        ).set_index("PI")
         invoice_month = "2024-03"
         with self.assertRaises(SystemExit):
             process_report.get_pi_age(old_pi_df, "PI1", invoice_month)
 
+    def test_get_pi_ages(self):
+        old_pi_df = process_report.load_old_pis(self.old_pi_file)
+        pi_ages = process_report.get_pi_ages(
+            old_pi_df, ["PI1", "NewPI1", "PI4", "PI7"], "2024-03"
+        )
+        self.assertEqual(list(pi_ages), [6, 0, 1, 0])
+
+
+class TestCreditAllocation(TestCase):
+    def _allocate_sequentially(self, amounts, budgets, group_codes):
+        remaining = {}
+        applied = []
+        applied_mask = []
+        for amount, budget, group in zip(amounts, budgets, group_codes):
+            credit = remaining.setdefault(group, budget)
+            applied_mask.append(credit != 0)
+            applied.append(min(amount, credit) if credit != 0 else 0)
+            remaining[group] = credit - applied[-1]
+        return applied, applied_mask
+
+    def test_allocate_in_row_order(self):
+        rng = numpy.random.default_rng(0)
+        for _ in range(50):
+            size = int(rng.integers(0, 40))
+            group_codes = rng.integers(0, 5, size)
+            group_budgets = rng.choice([0, -50, 100, 1000], 5)
+            amounts = rng.integers(-20, 400, size).astype(object)
+            budgets = group_budgets[group_codes].astype(object)
+
+            applied, applied_mask = process_report._allocate_in_row_order(
+                amounts, budgets, group_codes
+            )
+
+            answer_applied, answer_mask = self._allocate_sequentially(
+                amounts, budgets, group_codes
+            )
+            self.assertEqual(list(applied), answer_applied)
+            self.assertEqual(list(applied_mask), answer_mask)
+
+    def _apply_credits_per_row(self, dataframe, old_pi_df):
+        """The row by row New PI credit allocation that `apply_credits_new_pi`
+        replaced, kept as the reference it is checked against"""
+        new_pi_credit_code = "0002"
+        INITIAL_CREDIT_AMOUNT = 1000
+        EXCLUDE_SU_TYPES = ["OpenShift GPUA100SXM4", "OpenStack GPUA100SXM4"]
+
+        dataframe["Credit"] = None
+        dataframe["Credit Code"] = None
+        dataframe["Balance"] = Decimal(0)
+
+        current_pi_set = set(dataframe["Manager (PI)"])
+        invoice_month = dataframe["Invoice Month"].iat[0]
+        invoice_pis = old_pi_df[old_pi_df["First Invoice Month"] == invoice_month]
+        if invoice_pis["Initial Credits"].empty:
+            new_pi_credit_amount = INITIAL_CREDIT_AMOUNT
+        else:
+            new_pi_credit_amount = invoice_pis["Initial Credits"].iat[0]
+
+        for pi in current_pi_set:
+            pi_projects = dataframe[dataframe["Manager (PI)"] == pi]
+            first_month = old_pi_df.loc[old_pi_df["PI"] == pi, "First Invoice Month"]
+            pi_age = 0
+            if not first_month.empty:
+                pi_age = process_report.get_month_diff(
+                    invoice_month, first_month.iat[0]
+                )
+            pi_old_pi_entry = old_pi_df.loc[old_pi_df["PI"] == pi].squeeze()
+
+            if pi_age > 1:
+                for i, row in pi_projects.iterrows():
+                    dataframe.at[i, "Balance"] = row["Cost"]
+                continue
+            if pi_age == 0:
+                if len(pi_old_pi_entry) == 0:
+                    pi_entry = [pi, invoice_month, new_pi_credit_amount, 0, 0]
+                    old_pi_df = pandas.concat(
+                        [
+                            pandas.DataFrame([pi_entry], columns=old_pi_df.columns),
+                            old_pi_df,
+                        ],
+                        ignore_index=True,
+                    )
+                remaining_credit = new_pi_credit_amount
+                credit_used_field = "1st Month Used"
+            else:
+                remaining_credit = (
+                    pi_old_pi_entry["Initial Credits"]
+                    - pi_old_pi_entry["1st Month Used"]
+                )
+                credit_used_field = "2nd Month Used"
+
+            initial_credit = remaining_credit
+            for i, row in pi_projects.iterrows():
+                if remaining_credit == 0 or row["SU Type"] in EXCLUDE_SU_TYPES:
+                    dataframe.at[i, "Balance"] = row["Cost"]
+                else:
+                    applied_credit = min(row["Cost"], remaining_credit)
+                    dataframe.at[i, "Credit"] = applied_credit
+                    dataframe.at[i, "Credit Code"] = new_pi_credit_code
+                    dataframe.at[i, "Balance"] = row["Cost"] - applied_credit
+                    remaining_credit -= applied_credit
+
+            old_pi_df.loc[old_pi_df["PI"] == pi, credit_used_field] = (
+                initial_credit - remaining_credit
+            )
+
+        return dataframe, old_pi_df
+
+    def test_apply_credits_new_pi(self):
+        rng = numpy.random.default_rng(0)
+        su_types = ["OpenStack CPU", "OpenShift GPUA100SXM4", "OpenStack GPUA100SXM4"]
+        ledger_file = tempfile.NamedTemporaryFile(delete=False, suffix=".csv")
+        ledger_file.close()
+        self.addCleanup(os.remove, ledger_file.name)
+        for _ in range(30):
+            # PIs first billed this month, with and without a ledger entry, last
+            # month, and earlier, with ledgers with and without this month's credit
+            pis = [f"pi{i}" for i in range(int(rng.integers(1, 12)))]
+            first_months = rng.choice(["2024-03", None, "2024-02", "2023-06"], len(pis))
+            ledger = [
+                [
+                    pi,
+                    month,
+                    Decimal(int(rng.choice([500, 1000]))),
+                    Decimal(int(rng.choice([0, 250, 1000])))
+                    if month != "2024-03"
+                    else Decimal(0),
+                    Decimal(0),
+                ]
+                for pi, month in zip(pis, first_months)
+                if month is not None
+            ]
+            old_pi_df = pandas.DataFrame(
+                ledger,
+                columns=[
+                    "PI",
+                    "First Invoice Month",
+                    "Initial Credits",
+                    "1st Month Used",
+                    "2nd Month Used",
+                ],
+            )
+            old_pi_df.to_csv(ledger_file.name, index=False)
+
+            size = int(rng.integers(1, 40))
+            costs = [
+                Decimal(int(cents)).scaleb(-2) for cents in rng.integers(0, 80000, size)
+            ]
+            dataframe = pandas.DataFrame(
+                {
+                    "Invoice Month": "2024-03",
+                    "Manager (PI)": rng.choice(pis, size),
+                    "SU Type": rng.choice(su_types, size, p=[0.7, 0.15, 0.15]),
+                    "Cost": costs,
+                }
+            )
+
+            answer_df, answer_pi_df = self._apply_credits_per_row(
+                dataframe.copy(), old_pi_df.astype(object)
+            )
+            output_df = process_report.apply_credits_new_pi(
+                process_report.apply_invoice_dtypes(dataframe), ledger_file.name
+            )
+
+            self.assertEqual(
+                [
+                    None if pandas.isna(credit) else credit
+                    for credit in output_df["Credit"]
+                ],
+                list(answer_df["Credit"]),
+            )
+            self.assertEqual(
+                [
+                    None if pandas.isna(code) else code
+                    for code in output_df["Credit Code"]
+                ],
+                list(answer_df["Credit Code"]),
+            )
+            self.assertEqual(list(output_df["Balance"]), list(answer_df["Balance"]))
+            output_pi_df = process_report.load_old_pis(ledger_file.name)
+            self.assertEqual(
+                output_pi_df.sort_index().reset_index().values.tolist(),
+                answer_pi_df.sort_values("PI").values.tolist(),
+            )
+
 
 class TestBUSubsidy(TestCase):
     def setUp(self):
@@ -699,6 +1303,20 @@ class TestBUSubsidy(TestCase):
         self.assertEqual(0, output_df.loc[2, "Balance"])
         self.assertEqual(50, output_df.loc[3, "Balance"])
 
+    def test_BU_output(self):
+        process_report.export_BU_only(self.dataframe, self.output_file, self.subsidy)
+        answer = dedent(
+            """\
+            ,Invoice Month,Manager (PI),Project,Cost,Credit,Subsidy,Balance
+            0,2024-03,PI1,ProjectA,1550.00,1000,100,450.00
+            2,2024-03,PI2,ProjectB,1025.00,1000,25.00,0.00
+            6,2024-03,PI4,ProjectE-test,1050.00,1000,50.00,0.00
+            7,2024-03,PI4,ProjectF,100.00,0,50.00,50.00
+            """
+        )
+        with open(self.output_file) as f:
+            self.assertEqual(f.read(), answer)
+
 
 class TestValidateBillables(TestCase):
     def setUp(self):
@@ -788,34 +1406,1015 @@ class TestExportLenovo(TestCase):
             self.assertEqual(row["Charge"], row["SU Charge"] * row["SU Hours"])
 
 
-class TestUploadToS3(TestCase):
+class TestCSVWriters(TestCase):
+    def setUp(self):
+        data = {
+            "Invoice Month": ["2024-03"] * 6,
+            "Project - Allocation": [
+                "ProjectA-a1",
+                'Project "B"-b1',
+                "ProjectC, comma-c1",
+                "ProjectD\nline-d1",
+                "ProjectA-a2",
+                "",
+            ],
+            "Project - Allocation ID": ["id0", "id1", "id2", "id3", "id4", None],
+            "Manager (PI)": ["PI1", "PI1", "PI2", "PI3", "PI1", "PI4"],
+            "Institution": [
+                "Boston University",
+                "Boston University",
+                "Harvard University",
+                "MIT",
+                "Boston University",
+                None,
+            ],
+            "SU Hours (GBhr or SUhr)": [1.0, 0.1, None, 1e20, 720.0, 2.5],
+            "SU Type": [
+                "OpenShift GPUA100SXM4",
+                "OpenStack CPU",
+                "OpenStack GPUA100SXM4",
+                "OpenShift CPU",
+                "OpenShift GPUA100SXM4",
+                None,
+            ],
+            "Cost": ["100.00", "-0.05", "12345678.9", None, "0", "3"],
+            "Credit": [None, "0.05", None, None, "0", None],
+            "Credit Code": [None, "0002", None, None, "0002", None],
+            "Balance": ["100.00", "-0.10", "12345678.9", None, "0", "3"],
+        }
+        self.dataframe = process_report.apply_invoice_dtypes(pandas.DataFrame(data))
+
+    def test_format_csv_rows(self):
+        lines = process_report.format_csv_rows(self.dataframe)
+        self.assertEqual(len(lines), len(self.dataframe))
+        self.assertEqual(
+            "\n".join(lines) + "\n",
+            self.dataframe.to_csv(header=False, index=False, lineterminator="\n"),
+        )
+        self.assertIsNone(process_report.format_csv_rows(self.dataframe, "pandas"))
+
+    def test_writers_match(self):
+        outputs = {}
+        for writer in process_report.CSV_WRITERS:
+            output_dir = tempfile.TemporaryDirectory()
+            process_report.export_lenovo(
+                self.dataframe, f"{output_dir.name}/Lenovo.csv", writer
+            )
+            process_report.export_nonbillables(
+                self.dataframe, f"{output_dir.name}/nonbillable.csv", writer
+            )
+            process_report.export_invoices(
+                self.dataframe,
+                f"{output_dir.name}/billable.csv",
+                f"{output_dir.name}/HU_BU.csv",
+                f"{output_dir.name}/pi_invoices",
+                "2024-03",
+                writer=writer,
+            )
+            process_report.export_BU_only(
+                self.dataframe, f"{output_dir.name}/BU_Internal.csv", 100, writer
+            )
+            outputs[writer] = {}
+            for root, _, files in os.walk(output_dir.name):
+                for file in files:
+                    with open(os.path.join(root, file)) as f:
+                        outputs[writer][file] = f.read()
+
+        self.assertEqual(len(outputs["arrow"]), 9)
+        self.assertEqual(outputs["arrow"], outputs["pandas"])
+        self.assertEqual(
+            outputs["arrow"]["billable.csv"], self.dataframe.to_csv(index=False)
+        )
+
+
+class TestOutputFormats(TestCase):
+    def setUp(self):
+        data = {
+            "Invoice Month": ["2024-03"] * 4,
+            "Project - Allocation": ["ProjectA", "Project, B", "ProjectC", "ProjectD"],
+            "Manager (PI)": ["PI1", "PI1", "PI2", "PI3"],
+            "Institution": [
+                "Boston University",
+                "Boston University",
+                "Harvard University",
+                "MIT",
+            ],
+            "SU Hours (GBhr or SUhr)": [1.0, 0.1, None, 4.0],
+            "SU Type": [
+                "OpenShift GPUA100SXM4",
+                "OpenStack CPU",
+                None,
+                "OpenStack CPU",
+            ],
+            "Cost": ["100.00", "-0.05", "12345678.90", "0.10"],
+            "Credit": [None, "0.05", None, None],
+            "Balance": ["100.00", "-0.10", "12345678.90", "0.10"],
+        }
+        self.dataframe = process_report.apply_invoice_dtypes(pandas.DataFrame(data))
+
+    def export(self, output_format):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        output_files = {
+            name: process_report.with_output_format(
+                f"{output_dir.name}/{name}.csv", output_format
+            )
+            for name in ["billable", "HU_BU", "BU_Internal", "Lenovo", "nonbillable"]
+        }
+        process_report.export_invoices(
+            self.dataframe,
+            output_files["billable"],
+            output_files["HU_BU"],
+            f"{output_dir.name}/pi_invoices",
+            "2024-03",
+        )
+        process_report.export_BU_only(self.dataframe, output_files["BU_Internal"], 100)
+        process_report.export_lenovo(self.dataframe, output_files["Lenovo"])
+        process_report.export_nonbillables(self.dataframe, output_files["nonbillable"])
+
+        outputs = {}
+        for root, _, files in os.walk(output_dir.name):
+            for file in files:
+                name = file[: -len(output_format) - 1]
+                self.assertEqual(file, f"{name}.{output_format}")
+                outputs[name] = os.path.join(root, file)
+        return outputs
+
+    def test_with_output_format(self):
+        self.assertEqual(
+            process_report.with_output_format("a/b.csv", "parquet"), "a/b.parquet"
+        )
+        self.assertEqual(
+            process_report.with_output_format("b.csv.gz", "csv.zst"), "b.csv.zst"
+        )
+        self.assertEqual(
+            process_report.with_output_format("b.txt", "csv.gz"), "b.csv.gz"
+        )
+        self.assertEqual(process_report.with_output_format("b.txt", "csv"), "b.txt")
+        self.assertEqual(process_report.get_output_format("b.parquet"), "parquet")
+        self.assertEqual(process_report.get_output_format("b"), "csv")
+
+    def test_compressed_csv(self):
+        csv_outputs = self.export("csv")
+        self.assertEqual(len(csv_outputs), 8)
+        for output_format in ["csv.gz", "csv.zst"]:
+            outputs = self.export(output_format)
+            self.assertEqual(outputs.keys(), csv_outputs.keys())
+            for name, output_file in outputs.items():
+                with open(csv_outputs[name], "rb") as f:
+                    self.assertEqual(
+                        pyarrow.input_stream(output_file, compression="detect").read(),
+                        f.read(),
+                    )
+
+    def test_parquet(self):
+        csv_outputs = self.export("csv")
+        outputs = self.export("parquet")
+        self.assertEqual(outputs.keys(), csv_outputs.keys())
+        for name, output_file in outputs.items():
+            index = name not in ["billable", "nonbillable"]
+            # Parquet keeps the amounts, not whether they are written with cents
+            csv_text = pandas.read_parquet(output_file).to_csv(index=index)
+            pandas.testing.assert_frame_equal(
+                pandas.read_csv(io.StringIO(csv_text)),
+                pandas.read_csv(csv_outputs[name]),
+            )
+
+        schema = pyarrow.parquet.read_schema(outputs["billable"])
+        for field in ["Cost", "Credit", "Balance"]:
+            self.assertEqual(schema.field(field).type, pyarrow.decimal128(12, 2))
+
+    def test_output_buffers(self):
+        for output_format in ["csv", "csv.zst"]:
+            outputs = self.export(output_format)
+            output_dir = tempfile.TemporaryDirectory()
+            self.addCleanup(output_dir.cleanup)
+            output_buffers = {}
+            process_report.export_invoices(
+                self.dataframe,
+                f"billable.{output_format}",
+                f"HU_BU.{output_format}",
+                f"{output_dir.name}/pi_invoices",
+                "2024-03",
+                output_buffers=output_buffers,
+            )
+            process_report.export_lenovo(
+                self.dataframe, f"Lenovo.{output_format}", output_buffers=output_buffers
+            )
+            process_report.export_nonbillables(
+                self.dataframe,
+                f"nonbillable.{output_format}",
+                output_buffers=output_buffers,
+            )
+            self.assertEqual(os.listdir(output_dir.name), [])
+            self.assertEqual(len(output_buffers), len(outputs) - 1)
+
+            compression = process_report.OUTPUT_COMPRESSION.get(output_format)
+            for output_file, buffer in output_buffers.items():
+                name = os.path.basename(output_file)[: -len(output_format) - 1]
+                self.assertEqual(
+                    pyarrow.input_stream(
+                        pyarrow.BufferReader(buffer.getvalue()),
+                        compression=compression,
+                    ).read(),
+                    pyarrow.input_stream(outputs[name], compression=compression).read(),
+                )
+
+
+class TestInvoiceOutputs(TestCase):
+    def setUp(self):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(output_dir.name)
+
+    def run_main(self, hours, *args):
+        header = (
+            "Invoice Month,Project - Allocation,Manager (PI),Institution,"
+            "SU Hours (GBhr or SUhr),SU Type,Cost\n"
+        )
+        # main updates the PI file in place, so every run starts from these
+        for name, text in [
+            (
+                "a.csv",
+                header + "2024-03,ProjA-x,pi1@bu.edu,,10,OpenStack CPU,1500.00\n"
+                "2024-03,ProjA-y,pi1@bu.edu,,2,OpenStack CPU,10.00\n"
+                "2024-03,ProjB,pi2@harvard.edu,,3,OpenShift GPUA100SXM4,10.00\n"
+                "2024-03,ProjC,pi4@bu.edu,,7,OpenStack CPU,50.25\n",
+            ),
+            (
+                "b.csv",
+                header + f"2024-03,ProjD,pi3@bu.edu,,{hours},OpenStack CPU,30.00\n",
+            ),
+            (
+                "PI.csv",
+                "PI,First Invoice Month,Initial Credits,1st Month Used,2nd Month Used\n"
+                "pi2@harvard.edu,2023-01,1000,0,0\n"
+                "pi4@bu.edu,2024-02,1000,200,0\n"
+                "pi3@bu.edu,2023-05,1000,0,0\n",
+            ),
+            ("alias.csv", "pi1@bu.edu,pi1@old.bu.edu\n"),
+            ("pi.txt", "pi9@bu.edu\n"),
+            ("projects.txt", "ProjX\n"),
+            ("timed.csv", "PI,Project,Start Date,End Date,Reason\n"),
+        ]:
+            with open(name, "w") as f:
+                f.write(text)
+        argv = [
+            "process_report.py",
+            "a.csv",
+            "b.csv",
+            "--invoice-month=2024-03",
+            "--pi-file=pi.txt",
+            "--projects-file=projects.txt",
+            "--timed-projects-file=timed.csv",
+            "--old-pi-file=PI.csv",
+            "--alias-file=alias.csv",
+            "--BU-subsidy-amount=100",
+            *args,
+        ]
+        with mock.patch("sys.argv", argv):
+            process_report.main()
+        outputs = {}
+        for name in ["filtered_output.csv", "BU_Internal.csv", "Lenovo.csv"]:
+            with open(name) as f:
+                outputs[name] = f.read()
+        with open("PI.csv") as f:
+            outputs["PI.csv"] = sorted(f)
+        return outputs
+
+    def test_outputs(self):
+        # The invoices are written as they were when every amount was a Python
+        # number: the hours without a fraction while they all are whole, and
+        # whole credits and subsidies taken from a budget without cents
+        expected = {
+            "filtered_output.csv": dedent(
+                """\
+                Invoice Month,Project - Allocation,Manager (PI),Institution,SU Hours (GBhr or SUhr),SU Type,Cost,Credit,Credit Code,Balance
+                2024-03,ProjA-x,pi1@bu.edu,Boston University,10,OpenStack CPU,1500.00,1000,0002,500.00
+                2024-03,ProjA-y,pi1@bu.edu,Boston University,2,OpenStack CPU,10.00,,,10.00
+                2024-03,ProjB,pi2@harvard.edu,Harvard University,3,OpenShift GPUA100SXM4,10.00,,,10.00
+                2024-03,ProjC,pi4@bu.edu,Boston University,7,OpenStack CPU,50.25,50.25,0002,0.00
+                2024-03,ProjD,pi3@bu.edu,Boston University,4,OpenStack CPU,30.00,,,30.00
+                """
+            ),
+            "BU_Internal.csv": dedent(
+                """\
+                ,Invoice Month,Manager (PI),Project,Cost,Credit,Subsidy,Balance
+                0,2024-03,pi1@bu.edu,ProjA,1510.00,1000,100,410.00
+                3,2024-03,pi4@bu.edu,ProjC,50.25,50.25,0.00,0.00
+                4,2024-03,pi3@bu.edu,ProjD,30.00,0,30.00,0.00
+                """
+            ),
+            "Lenovo.csv": dedent(
+                """\
+                ,Invoice Month,Project - Allocation,Institution,SU Hours,SU Type,SU Charge,Charge
+                2,2024-03,ProjB,Harvard University,3,OpenShift GPUA100SXM4,1,3
+                """
+            ),
+            "PI.csv": [
+                "PI,First Invoice Month,Initial Credits,1st Month Used,2nd Month Used\n",
+                "pi1@bu.edu,2024-03,1000.00,1000.00,0.00\n",
+                "pi2@harvard.edu,2023-01,1000.00,0.00,0.00\n",
+                "pi3@bu.edu,2023-05,1000.00,0.00,0.00\n",
+                "pi4@bu.edu,2024-02,1000.00,200.00,50.25\n",
+            ],
+        }
+        for args in [(), ("--jobs=2", "--batch-size=256"), ("--csv-writer=pandas",)]:
+            self.assertEqual(self.run_main(4, *args), expected)
+
+        # One fraction makes all the hours floats
+        outputs = self.run_main(1.5)
+        self.assertEqual(
+            outputs["filtered_output.csv"].splitlines()[1:],
+            [
+                "2024-03,ProjA-x,pi1@bu.edu,Boston University,10.0,OpenStack CPU,1500.00,1000,0002,500.00",
+                "2024-03,ProjA-y,pi1@bu.edu,Boston University,2.0,OpenStack CPU,10.00,,,10.00",
+                "2024-03,ProjB,pi2@harvard.edu,Harvard University,3.0,OpenShift GPUA100SXM4,10.00,,,10.00",
+                "2024-03,ProjC,pi4@bu.edu,Boston University,7.0,OpenStack CPU,50.25,50.25,0002,0.00",
+                "2024-03,ProjD,pi3@bu.edu,Boston University,1.5,OpenStack CPU,30.00,,,30.00",
+            ],
+        )
+        self.assertIn(",3.0,OpenShift GPUA100SXM4,1,3.0\n", outputs["Lenovo.csv"])
+
+
+class TestFetchFromS3(TestCase):
+    def setUp(self):
+        process_report.get_invoice_bucket.cache_clear()
+        self.addCleanup(process_report.get_invoice_bucket.cache_clear)
+
+    @mock.patch.dict(os.environ, {"S3_KEY_ID": "key", "S3_APP_KEY": "secret"})
+    @mock.patch("process_report.process_report.boto3.resource")
+    def test_shared_bucket(self, mock_resource):
+        bucket = process_report.get_invoice_bucket()
+        self.assertIs(process_report.get_invoice_bucket(), bucket)
+        mock_resource.assert_called_once()
+        self.assertEqual(
+            mock_resource.call_args.kwargs["config"].max_pool_connections,
+            process_report.S3_MAX_POOL_CONNECTIONS,
+        )
+
     @mock.patch("process_report.process_report.get_invoice_bucket")
-    @mock.patch("process_report.process_report.get_iso8601_time")
-    def test_remove_prefix(self, mock_get_time, mock_get_bucket):
+    def test_fetch_s3_invoices(self, mock_get_bucket):
         mock_bucket = mock.MagicMock()
         mock_get_bucket.return_value = mock_bucket
-        mock_get_time.return_value = "0"
+        prefix = "Invoices/2024-03/Service Invoices/"
+        mock_bucket.objects.filter.return_value = [
+            mock.Mock(key=f"{prefix}{name}") for name in ["a.csv", "b.csv", "c.csv"]
+        ]
+        # Every download waits for the others, so they must run concurrently
+        barrier = threading.Barrier(3, timeout=5)
+        mock_bucket.download_file.side_effect = lambda key, local_name: barrier.wait()
+
+        self.assertEqual(
+            process_report.fetch_s3_invoices("2024-03"), ["a.csv", "b.csv", "c.csv"]
+        )
+        mock_bucket.objects.filter.assert_called_once_with(Prefix=prefix)
+        self.assertEqual(
+            sorted(call.args for call in mock_bucket.download_file.call_args_list),
+            [
+                (f"{prefix}a.csv", "a.csv"),
+                (f"{prefix}b.csv", "b.csv"),
+                (f"{prefix}c.csv", "c.csv"),
+            ],
+        )
+
+    @mock.patch("process_report.process_report.get_invoice_bucket")
+    def test_open_s3_invoices(self, mock_get_bucket):
+        mock_bucket = mock.MagicMock()
+        mock_get_bucket.return_value = mock_bucket
+        prefix = "Invoices/2024-03/Service Invoices/"
+        mock_bucket.objects.filter.return_value = [
+            mock.Mock(key=f"{prefix}{name}") for name in ["a.csv", "b.csv"]
+        ]
+        bodies = {
+            f"{prefix}a.csv": b"Invoice Month,Manager (PI),Cost\n2024-03,PI1,1.00\n",
+            f"{prefix}b.csv": b"Invoice Month,Manager (PI),Cost\n2024-03,PI2,2.50\n",
+        }
+        mock_bucket.Object.side_effect = lambda key: mock.Mock(
+            get=lambda: {"Body": io.BytesIO(bodies[key])}
+        )
+
+        expected = process_report.merge_csv(
+            [io.BytesIO(body) for body in bodies.values()]
+        )
+        for kwargs in [{}, {"batch_size": 32}, {"jobs": 2}]:
+            answer = process_report.merge_csv(
+                process_report.open_s3_invoices("2024-03"), **kwargs
+            )
+            self.assertTrue(answer.equals(expected))
+        self.assertEqual(expected[process_report.PI_FIELD].tolist(), ["PI1", "PI2"])
+        mock_bucket.download_file.assert_not_called()
+
+
+class TestS3Cache(TestCase):
+    def setUp(self):
+        self.objects = {"a.csv": ("etag-a", b"a"), "b.csv": ("etag-b", b"bb")}
+        self.mock_bucket = mock.MagicMock()
+        self.mock_bucket.name = "bucket"
+        self.mock_bucket.meta.client.head_object.side_effect = lambda Bucket, Key: {
+            "ETag": self.objects[Key][0],
+            "ContentLength": len(self.objects[Key][1]),
+        }
+
+        def download_file(key, local_name):
+            with open(local_name, "wb") as f:
+                f.write(self.objects[key][1])
+
+        def get_object(Bucket, Key, IfMatch):
+            if IfMatch != self.objects[Key][0]:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "412", "Message": "Precondition Failed"}},
+                    "GetObject",
+                )
+            return {"Body": io.BytesIO(self.objects[Key][1])}
+
+        self.mock_bucket.download_file.side_effect = download_file
+        self.mock_bucket.meta.client.get_object.side_effect = get_object
+        patcher = mock.patch(
+            "process_report.process_report.get_invoice_bucket",
+            return_value=self.mock_bucket,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir.name)
+        self.cache_dir = os.path.join(work_dir.name, "cache")
+
+    def fetch(self, **kwargs):
+        self.mock_bucket.download_file.reset_mock()
+        self.mock_bucket.meta.client.get_object.reset_mock()
+        downloads = [(key, f"local_{key}") for key in self.objects]
+        process_report.download_s3_files(downloads, **kwargs)
+        for key, local_name in downloads:
+            with open(local_name, "rb") as f:
+                self.assertEqual(f.read(), self.objects[key][1])
+            os.remove(local_name)
+        return sorted(
+            [
+                call_args.args[0]
+                for call_args in self.mock_bucket.download_file.call_args_list
+            ]
+            + [
+                call_args.kwargs["Key"]
+                for call_args in self.mock_bucket.meta.client.get_object.call_args_list
+            ]
+        )
+
+    def test_s3_cache(self):
+        self.assertEqual(self.fetch(cache_dir=self.cache_dir), ["a.csv", "b.csv"])
+        self.mock_bucket.download_file.assert_not_called()
+        self.assertCountEqual(
+            [
+                call_args.kwargs["IfMatch"]
+                for call_args in self.mock_bucket.meta.client.get_object.call_args_list
+            ],
+            ["etag-a", "etag-b"],
+        )
+        self.assertEqual(self.fetch(cache_dir=self.cache_dir), [])
+
+        self.objects["b.csv"] = ("etag-b2", b"b2")
+        self.assertEqual(self.fetch(cache_dir=self.cache_dir), ["b.csv"])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+        # The most recently used entry is kept
+        self.assertEqual(self.fetch(cache_dir=self.cache_dir, cache_max_size=0), [])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_no_cache(self):
+        self.assertEqual(self.fetch(), ["a.csv", "b.csv"])
+        self.assertEqual(self.fetch(), ["a.csv", "b.csv"])
+        self.mock_bucket.meta.client.head_object.assert_not_called()
+        self.mock_bucket.meta.client.get_object.assert_not_called()
+
+    def test_changed_object(self):
+        # An object changed after its HEAD request is not cached
+        head_object = self.mock_bucket.meta.client.head_object.side_effect
+
+        def change_object(Bucket, Key):
+            head = head_object(Bucket, Key)
+            self.objects[Key] = ("etag-changed", b"changed")
+            return head
+
+        self.mock_bucket.meta.client.head_object.side_effect = change_object
+        with self.assertRaises(botocore.exceptions.ClientError):
+            process_report.download_s3_files(
+                [("a.csv", "local_a.csv")], cache_dir=self.cache_dir
+            )
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class TestUploadToS3(TestCase):
+    def setUp(self):
+        self.mock_bucket = mock.MagicMock()
+        self.mock_bucket.name = "bucket"
+        patcher = mock.patch(
+            "process_report.process_report.get_invoice_bucket",
+            return_value=self.mock_bucket,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            "process_report.process_report.get_iso8601_time", return_value="0"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_uploads(self):
+        """Returns the uploaded files, their keys and the keys they were copied to"""
+        archive_keys = {}
+        for call_args in self.mock_bucket.meta.client.copy_object.call_args_list:
+            self.assertEqual(call_args.kwargs["Bucket"], "bucket")
+            self.assertEqual(call_args.kwargs["CopySource"]["Bucket"], "bucket")
+            archive_keys[call_args.kwargs["CopySource"]["Key"]] = call_args.kwargs[
+                "Key"
+            ]
+        return sorted(
+            (file, key, archive_keys.get(key))
+            for file, key in (
+                call_args.args
+                for call_args in self.mock_bucket.upload_file.call_args_list
+            )
+        )
 
+    def test_remove_prefix(self):
         invoice_month = "2024-03"
         filenames = ["test.csv", "test2.test.csv", "test3"]
         answers = [
-            ("test.csv", f"Invoices/{invoice_month}/test {invoice_month}.csv"),
             (
                 "test.csv",
+                f"Invoices/{invoice_month}/test {invoice_month}.csv",
                 f"Invoices/{invoice_month}/Archive/test {invoice_month} 0.csv",
             ),
             (
                 "test2.test.csv",
                 f"Invoices/{invoice_month}/test2.test {invoice_month}.csv",
+                f"Invoices/{invoice_month}/Archive/test2.test {invoice_month} 0.csv",
             ),
             (
-                "test2.test.csv",
-                f"Invoices/{invoice_month}/Archive/test2.test {invoice_month} 0.csv",
+                "test3",
+                f"Invoices/{invoice_month}/test3 {invoice_month}.csv",
+                f"Invoices/{invoice_month}/Archive/test3 {invoice_month} 0.csv",
             ),
-            ("test3", f"Invoices/{invoice_month}/test3 {invoice_month}.csv"),
-            ("test3", f"Invoices/{invoice_month}/Archive/test3 {invoice_month} 0.csv"),
         ]
 
         process_report.upload_to_s3(filenames, invoice_month)
-        for i, call_args in enumerate(mock_bucket.upload_file.call_args_list):
-            self.assertTrue(answers[i] in call_args)
+        self.assertEqual(self.get_uploads(), answers)
+
+    def test_output_format_keys(self):
+        process_report.upload_to_s3(["test.csv.zst", "test.parquet"], "2024-03")
+        process_report.upload_to_s3_HU_BU("HU_BU.csv.gz", "2024-03")
+        self.assertEqual(
+            self.get_uploads(),
+            [
+                (
+                    "HU_BU.csv.gz",
+                    "Invoices/2024-03/NERC-2024-03-Total-Invoice.csv.gz",
+                    "Invoices/2024-03/Archive/NERC-2024-03-Total-Invoice 0.csv.gz",
+                ),
+                (
+                    "test.csv.zst",
+                    "Invoices/2024-03/test 2024-03.csv.zst",
+                    "Invoices/2024-03/Archive/test 2024-03 0.csv.zst",
+                ),
+                (
+                    "test.parquet",
+                    "Invoices/2024-03/test 2024-03.parquet",
+                    "Invoices/2024-03/Archive/test 2024-03 0.parquet",
+                ),
+            ],
+        )
+
+    @mock.patch("process_report.process_report.time.sleep")
+    def test_upload_buffers(self, mock_sleep):
+        output_buffers = {}
+        for name in ["test.csv", "HU_BU.csv"]:
+            with process_report.open_output_file(name, output_buffers) as f:
+                f.write(f"{name}\n")
+
+        # A failed upload leaves the buffer partly read
+        uploaded = {}
+
+        def upload_fileobj(fileobj, key):
+            data = fileobj.read()
+            if key not in uploaded:
+                uploaded[key] = None
+                raise botocore.exceptions.EndpointConnectionError(endpoint_url="s3")
+            uploaded[key] = data
+
+        self.mock_bucket.upload_fileobj.side_effect = upload_fileobj
+        process_report.upload_to_s3(["test.csv"], "2024-03", output_buffers)
+        process_report.upload_to_s3_HU_BU("HU_BU.csv", "2024-03", output_buffers)
+
+        self.mock_bucket.upload_file.assert_not_called()
+        self.assertEqual(
+            uploaded,
+            {
+                "Invoices/2024-03/test 2024-03.csv": b"test.csv\n",
+                "Invoices/2024-03/NERC-2024-03-Total-Invoice.csv": b"HU_BU.csv\n",
+            },
+        )
+
+    @mock.patch("process_report.process_report.time.sleep")
+    def test_retry(self, mock_sleep):
+        error = botocore.exceptions.EndpointConnectionError(endpoint_url="s3")
+        self.mock_bucket.upload_file.side_effect = [error, error, None]
+
+        process_report.upload_to_s3_old_pi_file("PI.csv")
+        self.assertEqual(self.mock_bucket.upload_file.call_count, 3)
+        self.assertEqual(
+            [call_args.args for call_args in mock_sleep.call_args_list],
+            [(process_report.S3_RETRY_DELAY,), (process_report.S3_RETRY_DELAY * 2,)],
+        )
+
+        self.mock_bucket.upload_file.side_effect = error
+        with self.assertRaises(botocore.exceptions.EndpointConnectionError):
+            process_report.upload_to_s3_old_pi_file("PI.csv")
+        self.assertEqual(
+            self.mock_bucket.upload_file.call_count, 3 + process_report.S3_ATTEMPTS
+        )
+
+
+class TestRunStages(TestCase):
+    def test_run_stages(self):
+        calls = []
+        dataframe = pandas.DataFrame({"a": [1, 2, 3]})
+        stages = [
+            process_report.Stage(
+                "double",
+                lambda df: calls.append("double") or df * 2,
+                ("input",),
+                ("doubled",),
+            ),
+            process_report.Stage(
+                "split",
+                lambda df: (calls.append("split") or (df.head(1), df.tail(2))),
+                ("doubled",),
+                ("head", "tail"),
+                after=("log",),
+            ),
+            process_report.Stage("log", lambda: calls.append("log")),
+            process_report.Stage(
+                "sum",
+                lambda head, tail: int(head["a"].sum() + tail["a"].sum()),
+                ("head", "tail"),
+                ("total",),
+            ),
+        ]
+        values = {"input": dataframe}
+        metrics = process_report.run_stages(stages, values, trace_memory=True)
+
+        self.assertEqual(calls, ["double", "log", "split"])
+        self.assertEqual(
+            [stage["stage"] for stage in metrics], ["double", "log", "split", "sum"]
+        )
+        self.assertEqual([stage["rows"] for stage in metrics], [3, None, 3, None])
+        for stage in metrics:
+            self.assertGreaterEqual(stage["wall_time"], 0)
+            self.assertGreater(stage["peak_memory"], 0)
+            self.assertGreater(stage["max_rss"], 0)
+        # Only the values no stage took as input are kept
+        self.assertEqual(values, {"total": 12})
+
+    def test_parallel_stages(self):
+        # Each stage waits for the other, so they must run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [
+            process_report.Stage(name, barrier.wait, outputs=(name,))
+            for name in ["export_a", "export_b"]
+        ]
+        metrics = process_report.run_stages(stages, jobs=2)
+        self.assertEqual(len(metrics), 2)
+        self.assertIsNone(metrics[0]["peak_memory"])
+
+    def test_missing_inputs(self):
+        stages = [process_report.Stage("export", print, ("invoices",))]
+        with self.assertRaisesRegex(ValueError, "export"):
+            process_report.run_stages(stages)
+
+    def test_profile(self):
+        def export(dataframe):
+            return dataframe.sort_values("a")
+
+        stages = [process_report.Stage("export", export, ("invoices",), ("sorted",))]
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with mock.patch("builtins.print") as mock_print:
+                values = {"invoices": pandas.DataFrame({"a": [3, 1, 2]})}
+                process_report.run_stages(
+                    stages, values, jobs=2, profile_dir=profile_dir
+                )
+            self.assertEqual(values["sorted"]["a"].tolist(), [1, 2, 3])
+            self.assertEqual(
+                sorted(os.listdir(profile_dir)), ["export.folded", "export.prof"]
+            )
+
+            stats = pstats.Stats(os.path.join(profile_dir, "export.prof"))
+            self.assertIn("sort_values", {name for _, _, name in stats.stats})
+            with open(os.path.join(profile_dir, "export.folded")) as f:
+                stacks = [line.rsplit(" ", 1) for line in f]
+        self.assertTrue(all(int(weight) > 0 for _, weight in stacks))
+        self.assertTrue(
+            any(
+                stack.startswith(f"{__file__}:") and "(sort_values)" in stack
+                for stack, _ in stacks
+            )
+        )
+        self.assertEqual(
+            mock_print.call_args_list[0].args, ("Hottest functions of stage export:",)
+        )
+
+    def test_stage_report(self):
+        metrics = process_report.run_stages([process_report.Stage("a", dict)])
+        with tempfile.TemporaryDirectory() as report_dir:
+            report_file = os.path.join(report_dir, "report.json")
+            process_report.write_stage_report(report_file, metrics, 1.5)
+            with open(report_file) as f:
+                report = json.load(f)
+        self.assertEqual(report["wall_time"], 1.5)
+        self.assertEqual(report["stages"][0]["stage"], "a")
+
+
+class TestMainS3(TestCase):
+    def setUp(self):
+        self.get_invoice_bucket = process_report.get_invoice_bucket
+        self.objects = {}
+        self.mock_bucket = mock.MagicMock()
+        self.mock_bucket.name = "bucket"
+        self.mock_bucket.objects.filter.side_effect = lambda Prefix: [
+            mock.Mock(key=key) for key in sorted(self.objects) if key.startswith(Prefix)
+        ]
+        self.mock_bucket.Object.side_effect = lambda key: mock.Mock(
+            get=lambda: {"Body": io.BytesIO(self.objects[key])}
+        )
+        self.mock_bucket.download_file.side_effect = self.download_file
+        self.mock_bucket.meta.client.head_object.side_effect = self.head_object
+        self.mock_bucket.meta.client.get_object.side_effect = self.get_object
+        self.mock_bucket.upload_file.side_effect = self.upload_file
+        self.mock_bucket.upload_fileobj.side_effect = self.upload_fileobj
+        self.mock_bucket.meta.client.copy_object.side_effect = self.copy_object
+        for target, value in [
+            ("get_invoice_bucket", self.mock_bucket),
+            ("get_iso8601_time", "0"),
+        ]:
+            patcher = mock.patch(
+                f"process_report.process_report.{target}", return_value=value
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(output_dir.name)
+        for name, text in [
+            ("pi.txt", "pi9@bu.edu\n"),
+            ("projects.txt", "ProjectD\n"),
+            ("timed.csv", "PI,Project,Start Date,End Date,Reason\n"),
+        ]:
+            with open(name, "w") as f:
+                f.write(text)
+
+    def download_file(self, key, local_name, ExtraArgs=None):
+        with open(local_name, "wb") as f:
+            f.write(self.objects[key])
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": str(hash(self.objects[Key])), "ContentLength": 0}
+
+    def get_object(self, Bucket, Key, IfMatch):
+        self.assertEqual(IfMatch, self.head_object(Bucket, Key)["ETag"])
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def upload_file(self, local_file, key):
+        with open(local_file, "rb") as f:
+            self.objects[key] = f.read()
+
+    def upload_fileobj(self, fileobj, key):
+        self.objects[key] = fileobj.read()
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.objects[Key] = self.objects[CopySource["Key"]]
+
+    def run_main(self, *args):
+        header = (
+            "Invoice Month,Project - Allocation,Manager (PI),Institution,"
+            "SU Hours (GBhr or SUhr),SU Type,Cost\n"
+        )
+        self.objects.clear()
+        self.objects.update(
+            {
+                "Invoices/2024-03/Service Invoices/a.csv": (
+                    header + "2024-03,ProjectA,pi1@bu.edu,,1,OpenStack CPU,1000.00\n"
+                    "2024-03,ProjectB,pi2@harvard.edu,,1,OpenStack CPU,10.00\n"
+                ).encode(),
+                "Invoices/2024-03/Service Invoices/b.csv": (
+                    header
+                    + "2024-03,ProjectC,pi1@old.bu.edu,,1,OpenShift GPUH100,20.00\n"
+                    "2024-03,ProjectD,pi3@mit.edu,,1,OpenStack CPU,30.00\n"
+                ).encode(),
+                process_report.PI_S3_FILEPATH: (
+                    b"PI,First Invoice Month,Initial Credits,1st Month Used,2nd Month Used\n"
+                    b"pi2@harvard.edu,2023-01,1000,0,0\n"
+                ),
+                process_report.ALIAS_S3_FILEPATH: b"pi1@bu.edu,pi1@old.bu.edu\n",
+            }
+        )
+        argv = [
+            "process_report.py",
+            "--fetch-from-s3",
+            "--upload-to-s3",
+            "--invoice-month=2024-03",
+            "--pi-file=pi.txt",
+            "--projects-file=projects.txt",
+            "--timed-projects-file=timed.csv",
+            "--BU-subsidy-amount=100",
+            *args,
+        ]
+        with mock.patch("sys.argv", argv):
+            process_report.main()
+        return dict(self.objects)
+
+    def test_main(self):
+        # Streaming the invoices in both directions leaves no invoices on disk
+        streamed_objects = self.run_main("--s3-stream-inputs", "--s3-stream-outputs")
+        self.assertEqual(
+            sorted(os.listdir()),
+            [
+                "BU_Internal.csv",
+                "PI.csv",
+                "alias.csv",
+                "pi.txt",
+                "projects.txt",
+                "timed.csv",
+            ],
+        )
+
+        objects = self.run_main()
+        self.assertEqual(objects, streamed_objects)
+        self.assertEqual(
+            sorted(key for key in objects if "/Archive/" not in key),
+            [
+                "Invoices/2024-03/Lenovo 2024-03.csv",
+                "Invoices/2024-03/NERC-2024-03-Total-Invoice.csv",
+                "Invoices/2024-03/Service Invoices/a.csv",
+                "Invoices/2024-03/Service Invoices/b.csv",
+                "Invoices/2024-03/filtered_output 2024-03.csv",
+                "Invoices/2024-03/nonbillable 2024-03.csv",
+                "Invoices/2024-03/pi_invoices/Boston University_pi1@bu.edu_2024-03 2024-03.csv",
+                "Invoices/2024-03/pi_invoices/Harvard University_pi2@harvard.edu_2024-03 2024-03.csv",
+                "PIs/PI.csv",
+                "PIs/alias.csv",
+            ],
+        )
+        self.assertIn(b"pi1@bu.edu,2024-03", objects["PIs/PI.csv"])
+        self.assertIn(b"ProjectD", objects["Invoices/2024-03/nonbillable 2024-03.csv"])
+        self.assertEqual(
+            len([key for key in objects if "/Archive/" in key]),
+            7,
+        )
+
+    def test_output_folder(self):
+        # Streamed PI invoices are found and uploaded under the same keys as
+        # those on disk, however the folder is written
+        for output_folder in ["./pi_invoices", "pi_invoices/"]:
+            objects = self.run_main(f"--output-folder={output_folder}")
+            self.assertEqual(
+                len([key for key in objects if "_2024-03 2024-03.csv" in key]), 2
+            )
+            self.assertEqual(
+                self.run_main(
+                    "--s3-stream-outputs", f"--output-folder={output_folder}"
+                ),
+                objects,
+            )
+
+    def test_shared_bucket(self):
+        resources = []
+
+        def resource(**kwargs):
+            # Gives the stages fetching from S3 time to overlap
+            time.sleep(0.1)
+            resources.append(kwargs)
+            return mock.Mock(**{"Bucket.return_value": self.mock_bucket})
+
+        self.get_invoice_bucket.cache_clear()
+        self.addCleanup(self.get_invoice_bucket.cache_clear)
+        with mock.patch(
+            "process_report.process_report.get_invoice_bucket",
+            self.get_invoice_bucket,
+        ), mock.patch("boto3.resource", resource), mock.patch.dict(
+            os.environ, {"S3_KEY_ID": "key", "S3_APP_KEY": "secret"}
+        ):
+            self.run_main("--s3-stream-inputs")
+        self.assertEqual(len(resources), 1)
+
+    def test_missing_s3_cache_dir(self):
+        # The PI and alias files are fetched into a cache directory not made yet
+        objects = self.run_main("--s3-stream-inputs", "--s3-cache-dir=cache/s3")
+        self.assertEqual(len(os.listdir("cache/s3")), 2)
+        self.assertEqual(objects, self.run_main("--no-s3-cache"))
+
+    def test_local_inputs(self):
+        self.run_main()
+        for key, name in [
+            ("Invoices/2024-03/Service Invoices/a.csv", "a.csv"),
+            (process_report.PI_S3_FILEPATH, "PI.csv"),
+            (process_report.ALIAS_S3_FILEPATH, "alias.csv"),
+        ]:
+            with open(name, "wb") as f:
+                f.write(self.objects[key])
+
+        # Nothing is fetched, so the S3 cache directory is neither read nor made
+        argv = [
+            "process_report.py",
+            "a.csv",
+            "--invoice-month=2024-03",
+            "--pi-file=pi.txt",
+            "--projects-file=projects.txt",
+            "--timed-projects-file=timed.csv",
+            "--BU-subsidy-amount=100",
+            "--old-pi-file=PI.csv",
+            "--alias-file=alias.csv",
+            "--s3-cache-dir=cache/s3",
+        ]
+        with mock.patch("sys.argv", argv):
+            process_report.main()
+        self.assertFalse(os.path.exists("cache"))
+        self.mock_bucket.meta.client.head_object.assert_not_called()
+
+
+@skipUnless(getattr(moto, "mock_aws", None), "moto is not installed")
+class TestMockedS3(TestCase):
+    def setUp(self):
+        mock_aws = moto.mock_aws()
+        mock_aws.start()
+        self.addCleanup(mock_aws.stop)
+        environ = mock.patch.dict(
+            os.environ,
+            {
+                "S3_KEY_ID": "key",
+                "S3_APP_KEY": "secret",
+                "S3_ENDPOINT": "https://s3.amazonaws.com",
+                "S3_BUCKET_NAME": "invoices",
+                "AWS_DEFAULT_REGION": "us-east-1",
+            },
+        )
+        environ.start()
+        self.addCleanup(environ.stop)
+        process_report.get_invoice_bucket.cache_clear()
+        self.addCleanup(process_report.get_invoice_bucket.cache_clear)
+        self.bucket = process_report.get_invoice_bucket()
+        self.bucket.create()
+
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(output_dir.name)
+
+    def test_upload_and_fetch(self):
+        os.mkdir("pi_invoices")
+        invoices = ["NERC.csv", "pi_invoices/BU_pi1_2024-03.csv"]
+        for invoice in invoices:
+            with open(invoice, "w") as f:
+                f.write(f"{invoice}\n")
+
+        process_report.upload_to_s3(invoices, "2024-03")
+        objects = {
+            obj.key: obj.get()["Body"].read() for obj in self.bucket.objects.all()
+        }
+        self.assertEqual(len(objects), 4)
+        self.assertEqual(objects["Invoices/2024-03/NERC 2024-03.csv"], b"NERC.csv\n")
+        self.assertEqual(
+            objects["Invoices/2024-03/pi_invoices/BU_pi1_2024-03 2024-03.csv"],
+            b"pi_invoices/BU_pi1_2024-03.csv\n",
+        )
+        archived = [key for key in objects if "/Archive/" in key]
+        self.assertEqual(len(archived), 2)
+        for key in archived:
+            self.assertIn(
+                objects[key], [b"NERC.csv\n", b"pi_invoices/BU_pi1_2024-03.csv\n"]
+            )
+
+        for name in ["a.csv", "b.csv"]:
+            self.bucket.put_object(
+                Key=f"Invoices/2024-03/Service Invoices/{name}", Body=name.encode()
+            )
+        os.mkdir("fetched")
+        os.chdir("fetched")
+        self.assertEqual(
+            sorted(process_report.fetch_s3_invoices("2024-03")), ["a.csv", "b.csv"]
+        )
+        with open("b.csv") as f:
+            self.assertEqual(f.read(), "b.csv")
+
+    def test_fetch_cached(self):
+        key = "Invoices/2024-03/Service Invoices/a.csv"
+        for body in [b"a", b"a", b"changed"]:
+            self.bucket.put_object(Key=key, Body=body)
+            process_report.download_s3_files([(key, "a.csv")], cache_dir="cache")
+            with open("a.csv", "rb") as f:
+                self.assertEqual(f.read(), body)
+        self.assertEqual(len(os.listdir("cache")), 2)